@@ -0,0 +1,74 @@
+"""Micro-benchmark of AnsiCodeProcessor on typical kernel output.
+
+Compares the general split_string path with the split_lines fast path on
+plain text, colored tracebacks and tqdm-style progress bars.
+
+    python bench/bench_ansi.py [--repeat N]
+"""
+from __future__ import print_function, division
+import argparse
+import importlib.util
+import os
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ANSI_PATH = os.path.join(HERE, '..', 'rplugin', 'python3', 'nvim_ipy',
+                         'ansi_code_processor.py')
+
+def load_ansi():
+    # load the module standalone, the package needs neovim and jupyter
+    spec = importlib.util.spec_from_file_location('ansi_code_processor', ANSI_PATH)
+    mod = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(mod)
+    return mod
+
+def make_inputs():
+    plain = ''.join('line {} of some ordinary printed output\n'.format(i)
+                    for i in range(20000))
+    frame = ('\x1b[0;32m/home/user/project/module.py\x1b[0m in \x1b[0;36mfunc'
+             '\x1b[1;34m(x, y)\x1b[0m\n\x1b[1;32m---> 12\x1b[0m     '
+             '\x1b[38;5;28mreturn\x1b[39m x \x1b[38;5;241m/\x1b[39m y\n')
+    colored = frame * 4000
+    progress = ''.join('\r{:3d}%|{:<50}| {}/10000 [00:01<00:00, 9000.00it/s]'
+                       .format(i // 100, '#' * (i // 200), i)
+                       for i in range(10000)) + '\n'
+    return [('plain', plain), ('colored', colored), ('progress', progress)]
+
+def consume_general(proc, data):
+    n = 0
+    for chunk in proc.split_string(data):
+        n += 1
+    return n
+
+def consume_fast(proc, data):
+    lines = proc.split_lines(data)
+    if lines is not None:
+        return len(lines)
+    return consume_general(proc, data)
+
+def bench(fn, mod, data, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        proc = mod.AnsiCodeProcessor()
+        proc.bold_text_enabled = True
+        t0 = time.perf_counter()
+        fn(proc, data)
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    mod = load_ansi()
+    print('{:<10} {:>10} {:>14} {:>14}'.format('input', 'size', 'general MB/s', 'fast MB/s'))
+    for name, data in make_inputs():
+        mb = len(data) / 1e6
+        general = bench(consume_general, mod, data, args.repeat)
+        fast = bench(consume_fast, mod, data, args.repeat)
+        print('{:<10} {:>10} {:>14.1f} {:>14.1f}'.format(
+            name, len(data), mb / general, mb / fast))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+"""Check the cost of loading the plugin module, which nvim pays at startup.
+
+Imports nvim_ipy in fresh interpreters, and fails if the best time is over
+the budget, or if jupyter/zmq/traitlets were imported; those are only
+needed once connecting to a kernel.
+
+    python bench/bench_import.py [--budget-ms 30] [--repeat 5]
+
+Requires pynvim.
+"""
+from __future__ import print_function
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+RPLUGIN = os.path.join(os.path.dirname(HERE), 'rplugin', 'python3')
+
+# modules which must not be loaded by importing the plugin
+DEFERRED = ['jupyter_client', 'jupyter_core', 'zmq', 'traitlets']
+
+# time only the plugin, on top of the host's own imports
+SCRIPT = """
+import json, sys, time
+import neovim
+t0 = time.perf_counter()
+import nvim_ipy
+t = time.perf_counter() - t0
+print(json.dumps({'ms': t * 1000, 'modules': sorted(sys.modules)}))
+"""
+
+def measure():
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [RPLUGIN, env.get('PYTHONPATH')]))
+    out = subprocess.check_output([sys.executable, '-c', SCRIPT], env=env)
+    return json.loads(out.decode('utf-8'))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--budget-ms', type=float, default=30)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    results = [measure() for i in range(args.repeat)]
+    best = min(r['ms'] for r in results)
+    loaded = [m for m in DEFERRED if m in results[0]['modules']]
+    print('import nvim_ipy: {:.1f}ms (best of {}), budget {:.0f}ms'.format(
+        best, args.repeat, args.budget_ms))
+    failed = False
+    if loaded:
+        print('FAIL: imported at load time: ' + ', '.join(loaded))
+        failed = True
+    if best > args.budget_ms:
+        print('FAIL: over budget')
+        failed = True
+    sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,164 @@
+"""A stub Jupyter kernel which replays scripted iopub traffic.
+
+It speaks enough of the messaging protocol for nvim-ipy to connect with
+`--existing`. Executing code of the form `SCENARIO COUNT`, for instance
+`plain 10000`, publishes COUNT outputs of that kind:
+
+    plain      lines of ordinary print() output, one stream message each
+    colored    colored traceback-like lines, one stream message each
+    progress   tqdm-style progress bar updates separated by \\r
+    result     an execute_result with a text/plain repr of COUNT lines
+    traceback  an error with a colored traceback of COUNT frames
+
+    python bench/fake_kernel.py CONNECTION_FILE
+"""
+from __future__ import print_function
+import os
+import sys
+import threading
+import uuid
+
+import zmq
+from jupyter_client.connect import write_connection_file
+from jupyter_client.session import Session
+
+LANGUAGE_INFO = {
+    'name': 'python',
+    'version': '{}.{}.{}'.format(*sys.version_info[:3]),
+    'mimetype': 'text/x-python',
+    'file_extension': '.py',
+}
+
+def plain(n):
+    for i in range(n):
+        yield 'stream', {'name': 'stdout', 'text': 'line {} of ordinary output\n'.format(i)}
+
+COLORED_LINE = ('\x1b[0;32m/home/user/project/module.py\x1b[0m in \x1b[0;36mfunc'
+                '\x1b[1;34m(x={})\x1b[0m \x1b[38;5;241m# comment\x1b[39m\n')
+
+def colored(n):
+    for i in range(n):
+        yield 'stream', {'name': 'stdout', 'text': COLORED_LINE.format(i)}
+
+def progress(n):
+    for i in range(n):
+        pct = 100 * i // n
+        text = '\r{:3d}%|{:<50}| {}/{}'.format(pct, '#' * (pct // 2), i, n)
+        yield 'stream', {'name': 'stderr', 'text': text}
+    yield 'stream', {'name': 'stderr', 'text': '\n'}
+
+def result(n):
+    text = '\n'.join('{:8d}  {:>12.6f}  {:>12.6f}  row'.format(i, i * 0.5, i * 0.25)
+                     for i in range(n))
+    yield 'execute_result', {'data': {'text/plain': text}, 'metadata': {}}
+
+def traceback(n):
+    frames = [COLORED_LINE.format(i).rstrip('\n') for i in range(n)]
+    yield 'error', {'ename': 'ValueError', 'evalue': 'bench',
+                    'traceback': frames + ['\x1b[0;31mValueError\x1b[0m: bench']}
+
+SCENARIOS = {
+    'plain': plain,
+    'colored': colored,
+    'progress': progress,
+    'result': result,
+    'traceback': traceback,
+}
+
+class FakeKernel(object):
+    def __init__(self, connection_file):
+        self.ctx = zmq.Context()
+        self.session = Session(key=uuid.uuid4().hex.encode('ascii'))
+        ip = '127.0.0.1'
+        addr = 'tcp://' + ip
+        self.shell = self.ctx.socket(zmq.ROUTER)
+        self.control = self.ctx.socket(zmq.ROUTER)
+        self.stdin = self.ctx.socket(zmq.ROUTER)
+        self.iopub = self.ctx.socket(zmq.PUB)
+        self.hb = self.ctx.socket(zmq.REP)
+        ports = {name + '_port': getattr(self, name).bind_to_random_port(addr)
+                 for name in ['shell', 'control', 'stdin', 'iopub', 'hb']}
+        self.execution_count = 0
+        write_connection_file(connection_file, ip=ip, key=self.session.key,
+                              signature_scheme=self.session.signature_scheme,
+                              kernel_name='fake', **ports)
+
+    def heartbeat(self):
+        while True:
+            self.hb.send(self.hb.recv())
+
+    def publish(self, msg_type, content, parent):
+        self.session.send(self.iopub, msg_type, content, parent=parent)
+
+    def run(self):
+        threading.Thread(target=self.heartbeat, daemon=True).start()
+        poller = zmq.Poller()
+        poller.register(self.shell, zmq.POLLIN)
+        poller.register(self.control, zmq.POLLIN)
+        while True:
+            for sock, _ in poller.poll():
+                idents, msg = self.session.recv(sock, mode=0)
+                if msg is None:
+                    continue
+                self.publish('status', {'execution_state': 'busy'}, msg)
+                handler = getattr(self, 'do_' + msg['header']['msg_type'], None)
+                if handler is not None:
+                    reply_type, content = handler(msg)
+                    self.session.send(sock, reply_type, content, parent=msg, ident=idents)
+                self.publish('status', {'execution_state': 'idle'}, msg)
+                if msg['header']['msg_type'] == 'shutdown_request':
+                    return
+
+    def do_kernel_info_request(self, msg):
+        return 'kernel_info_reply', {
+            'status': 'ok',
+            'protocol_version': '5.3',
+            'implementation': 'fake',
+            'implementation_version': '0.1',
+            'language_info': LANGUAGE_INFO,
+            'banner': 'nvim-ipy benchmark kernel',
+        }
+
+    def do_execute_request(self, msg):
+        code = msg['content']['code']
+        silent = msg['content'].get('silent', False)
+        if not silent:
+            self.execution_count += 1
+            self.publish('execute_input', {'code': code,
+                                           'execution_count': self.execution_count}, msg)
+        words = code.split()
+        status = 'ok'
+        if words and words[0] in SCENARIOS:
+            count = int(words[1]) if len(words) > 1 else 1
+            for msg_type, content in SCENARIOS[words[0]](count):
+                if msg_type == 'execute_result':
+                    content['execution_count'] = self.execution_count
+                elif msg_type == 'error':
+                    status = 'error'
+                self.publish(msg_type, content, msg)
+        reply = {'status': status, 'execution_count': self.execution_count}
+        if status == 'ok':
+            reply.update(payload=[], user_expressions={})
+        else:
+            reply.update(ename='ValueError', evalue='bench', traceback=[])
+        return 'execute_reply', reply
+
+    def do_complete_request(self, msg):
+        pos = msg['content']['cursor_pos']
+        return 'complete_reply', {'status': 'ok', 'matches': [], 'cursor_start': pos,
+                                  'cursor_end': pos, 'metadata': {}}
+
+    def do_inspect_request(self, msg):
+        return 'inspect_reply', {'status': 'ok', 'found': False, 'data': {}, 'metadata': {}}
+
+    def do_shutdown_request(self, msg):
+        return 'shutdown_reply', {'status': 'ok', 'restart': False}
+
+def main():
+    if len(sys.argv) != 2:
+        sys.exit(__doc__)
+    kernel = FakeKernel(os.path.abspath(sys.argv[1]))
+    kernel.run()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,182 @@
+"""End-to-end benchmark of nvim-ipy against a stub kernel.
+
+Starts bench/fake_kernel.py and a headless `nvim --embed` with this plugin
+loaded, connects with `:IPython --existing`, runs each scenario and reports
+messages per second, output latency percentiles from IPyStats() and the peak
+memory of nvim and the python host. Results are compared to a stored
+baseline, and the exit status is non-zero if any scenario regressed by more
+than the tolerance.
+
+    python bench/run_bench.py [--save-baseline] [--baseline FILE] [--tolerance 0.25]
+
+Requires nvim, pynvim and jupyter_client.
+"""
+from __future__ import print_function, division
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import pynvim
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+DEFAULT_BASELINE = os.path.join(HERE, 'baseline.json')
+
+# name, code, number of iopub output messages
+SCENARIOS = [
+    ('plain', 'plain 20000', 20000),
+    ('colored', 'colored 5000', 5000),
+    ('progress', 'progress 20000', 20001),
+    ('result', 'result 100000', 1),
+    ('traceback', 'traceback 2000', 1),
+]
+
+def nvim_argv(embed=True):
+    return (['nvim'] + (['--embed'] if embed else []) +
+            ['--headless', '--clean', '-n',
+             '--cmd', 'set rtp^=' + ROOT,
+             '--cmd', 'let g:python3_host_prog = ' + json.dumps(sys.executable)])
+
+def update_remote_plugins(env):
+    subprocess.check_call(nvim_argv(embed=False) + ['-c', 'UpdateRemotePlugins', '-c', 'qa!'],
+                          env=env, stdout=subprocess.DEVNULL)
+
+def wait_until(pred, timeout=120, interval=0.005):
+    deadline = time.time() + timeout
+    while not pred():
+        if time.time() > deadline:
+            raise RuntimeError('benchmark timed out')
+        time.sleep(interval)
+
+def peak_rss_kb(pid):
+    """VmHWM of a process, on linux."""
+    try:
+        with open('/proc/{}/status'.format(pid)) as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except (IOError, OSError):
+        pass
+    return None
+
+def child_pids(pid):
+    try:
+        with open('/proc/{}/task/{}/children'.format(pid, pid)) as f:
+            return [int(p) for p in f.read().split()]
+    except (IOError, OSError):
+        return []
+
+def run_scenario(nvim, code, nmsgs):
+    nvim.vars['ipy_status'] = ''
+    nvim.call('IPyStats', 1)
+    t0 = time.time()
+    nvim.call('IPyRun', code)
+    # the idle status is handled after all output was written
+    wait_until(lambda: nvim.vars['ipy_status'] == 'idle')
+    elapsed = time.time() - t0
+    stats = nvim.call('IPyStats')['latency']
+    latency = stats.get('output_latency', {})
+    return {
+        'seconds': elapsed,
+        'msgs_per_sec': nmsgs / elapsed,
+        'latency_p50_ms': latency.get('p50'),
+        'latency_p99_ms': latency.get('p99'),
+        'render_p50_ms': stats.get('render', {}).get('p50'),
+    }
+
+def run(args):
+    tmp = tempfile.mkdtemp(prefix='nvim-ipy-bench')
+    env = dict(os.environ, NVIM_RPLUGIN_MANIFEST=os.path.join(tmp, 'rplugin.vim'))
+    connection_file = os.path.join(tmp, 'kernel.json')
+    kernel = subprocess.Popen([sys.executable, os.path.join(HERE, 'fake_kernel.py'),
+                               connection_file])
+    nvim = None
+    try:
+        update_remote_plugins(env)
+        wait_until(lambda: os.path.exists(connection_file), timeout=30)
+        os.environ['NVIM_RPLUGIN_MANIFEST'] = env['NVIM_RPLUGIN_MANIFEST']
+        nvim = pynvim.attach('child', argv=nvim_argv())
+        nvim.command('set lines=50 columns=200')
+        nvim.call('IPyConnect', '--existing', connection_file)
+        wait_until(lambda: any(b.name.endswith('[jupyter]') and len(b) > 3
+                               for b in nvim.buffers), timeout=60)
+
+        results = {}
+        for name, code, nmsgs in SCENARIOS:
+            if args.only and name not in args.only:
+                continue
+            results[name] = run_scenario(nvim, code, nmsgs)
+            print('{:<10} {:>8.2f}s {:>10.0f} msg/s  p50 {}  p99 {}'.format(
+                name, results[name]['seconds'], results[name]['msgs_per_sec'],
+                fmt_ms(results[name]['latency_p50_ms']),
+                fmt_ms(results[name]['latency_p99_ms'])))
+
+        nvim_pid = nvim.call('getpid')
+        memory = {'nvim_kb': peak_rss_kb(nvim_pid)}
+        for pid in child_pids(nvim_pid):
+            memory['host_kb'] = max(memory.get('host_kb') or 0, peak_rss_kb(pid) or 0)
+        print('peak memory: nvim {} kB, python host {} kB'.format(
+            memory['nvim_kb'], memory.get('host_kb')))
+        results['memory'] = memory
+        return results
+    finally:
+        if nvim is not None:
+            nvim.quit()
+        kernel.kill()
+        shutil.rmtree(tmp, ignore_errors=True)
+
+def fmt_ms(value):
+    return '-' if value is None else '{:.1f}ms'.format(value)
+
+def compare(results, baseline, tolerance):
+    """Print regressions compared to the baseline, returns their number."""
+    regressions = 0
+    for name, res in results.items():
+        base = baseline.get(name)
+        if name == 'memory' or base is None:
+            continue
+        # lower is better for all of these, except throughput
+        if res['msgs_per_sec'] < base['msgs_per_sec'] * (1 - tolerance):
+            print('REGRESSION {}: {:.0f} msg/s, baseline {:.0f}'.format(
+                name, res['msgs_per_sec'], base['msgs_per_sec']))
+            regressions += 1
+        for key in ['latency_p50_ms', 'latency_p99_ms']:
+            if res.get(key) is not None and base.get(key) is not None:
+                if res[key] > base[key] * (1 + tolerance):
+                    print('REGRESSION {} {}: {:.1f}, baseline {:.1f}'.format(
+                        name, key, res[key], base[key]))
+                    regressions += 1
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE)
+    parser.add_argument('--save-baseline', action='store_true',
+                        help='store the results as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=0.25)
+    parser.add_argument('--output', help='also write the results as JSON to this file')
+    parser.add_argument('only', nargs='*', help='scenarios to run (default all)')
+    args = parser.parse_args()
+
+    results = run(args)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print('saved baseline to', args.baseline)
+    elif os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            if compare(results, json.load(f), args.tolerance):
+                sys.exit(1)
+    else:
+        print('no baseline at {}, run with --save-baseline to create it'.format(args.baseline))
+
+if __name__ == '__main__':
+    main()
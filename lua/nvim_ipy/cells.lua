@@ -0,0 +1,197 @@
+-- index of cell boundaries in source buffers, kept up to date on changes
+local api = vim.api
+
+local M = {}
+
+-- buf: {start = pattern, stop = pattern, starts = {lnum}, stops = {lnum}}
+-- with sorted 1-based line numbers of the lines matching the patterns. For
+-- an implicit celldef (a single pattern), stop is '' and stops is starts.
+M.index = {}
+
+-- number of elements of list which are <= x
+local function count_le(list, x)
+  local lo, hi = 0, #list
+  while lo < hi do
+    local mid = math.floor((lo + hi + 1) / 2)
+    if list[mid] <= x then
+      lo = mid
+    else
+      hi = mid - 1
+    end
+  end
+  return lo
+end
+
+local function matching(buf, regex, first, last)
+  local res = {}
+  for i, line in ipairs(api.nvim_buf_get_lines(buf, first, last, false)) do
+    if regex:match_str(line) then
+      res[#res+1] = first + i
+    end
+  end
+  return res
+end
+
+-- remove lnums in [first, last_old], shift the ones after, and insert news
+local function update(list, first, last_old, delta, news)
+  local lo = count_le(list, first - 1)
+  local hi = count_le(list, last_old)
+  local res = {}
+  for i = 1, lo do
+    res[i] = list[i]
+  end
+  for _, lnum in ipairs(news) do
+    res[#res+1] = lnum
+  end
+  for i = hi + 1, #list do
+    res[#res+1] = list[i] + delta
+  end
+  return res
+end
+
+local function build(buf, start, stop)
+  local idx = {start = start, stop = stop, start_re = vim.regex(start)}
+  idx.starts = matching(buf, idx.start_re, 0, -1)
+  if stop ~= '' then
+    idx.stop_re = vim.regex(stop)
+    idx.stops = matching(buf, idx.stop_re, 0, -1)
+  else
+    idx.stops = idx.starts
+  end
+  return idx
+end
+
+local function on_lines(_, buf, _, first, last_old, last_new)
+  local idx = M.index[buf]
+  if idx == nil then
+    return true
+  end
+  local delta = last_new - last_old
+  idx.starts = update(idx.starts, first + 1, last_old, delta,
+                      matching(buf, idx.start_re, first, last_new))
+  if idx.stop_re then
+    idx.stops = update(idx.stops, first + 1, last_old, delta,
+                       matching(buf, idx.stop_re, first, last_new))
+  else
+    idx.stops = idx.starts
+  end
+end
+
+local function get_index(buf, start, stop)
+  if buf == 0 then
+    buf = api.nvim_get_current_buf()
+  end
+  local idx = M.index[buf]
+  if idx == nil or idx.start ~= start or idx.stop ~= stop then
+    local attach = idx == nil
+    idx = build(buf, start, stop)
+    M.index[buf] = idx
+    if attach then
+      api.nvim_buf_attach(buf, false, {
+        on_lines = on_lines,
+        on_reload = function(_, b)
+          local old = M.index[b]
+          if old then
+            M.index[b] = build(b, old.start, old.stop)
+          end
+        end,
+        on_detach = function(_, b)
+          M.index[b] = nil
+        end,
+      })
+    end
+  end
+  return buf, idx
+end
+
+-- Cell containing lnum, like searching for the celldef patterns from the
+-- cursor: {lnum1, lnum2} of the boundary lines (0 and line count + 1 for
+-- implicit cells at the ends of the buffer), or nil.
+local function find(buf, idx, lnum)
+  local implicit = idx.stop == ''
+  local i = count_le(idx.stops, lnum)
+  local lnum2 = idx.stops[i + 1]
+  if lnum2 == nil then
+    if not implicit then
+      return nil
+    end
+    lnum2 = api.nvim_buf_line_count(buf) + 1
+  end
+  local lnum1 = idx.starts[count_le(idx.starts, lnum2 - 1)] or 0
+  if lnum1 == 0 and not implicit then
+    return nil
+  end
+  return {lnum1, lnum2}
+end
+
+local function cell_info(buf, idx, cell)
+  local lines = api.nvim_buf_get_lines(buf, cell[1], math.max(cell[2] - 1, cell[1]), false)
+  local skip = 0
+  while skip < #lines and lines[skip + 1]:match('^%s*$') do
+    skip = skip + 1
+  end
+  -- first line of the next cell
+  local next = idx.stop == '' and cell[2] or cell[2] + 1
+  return {
+    start = cell[1] + 1,
+    stop = cell[2] - 1,
+    next = math.min(next, api.nvim_buf_line_count(buf)),
+    code = table.concat(lines, '\n', skip + 1),
+  }
+end
+
+-- The cell around lnum in buf, as {start, stop, next, code} where start and
+-- stop are the first and last line of the content, and next the line to
+-- move to for the next cell. Empty dict when not in a cell.
+function M.cell(buf, start, stop, lnum)
+  local idx
+  buf, idx = get_index(buf, start, stop)
+  local cell = find(buf, idx, lnum)
+  if cell == nil then
+    return vim.empty_dict()
+  end
+  return cell_info(buf, idx, cell)
+end
+
+-- All cells of buf in order, or only the ones ending before line `before`.
+function M.cells(buf, start, stop, before)
+  local idx
+  buf, idx = get_index(buf, start, stop)
+  local res = {}
+  local prev = -1
+  local cells = {}
+  if idx.stop == '' then
+    local n = api.nvim_buf_line_count(buf)
+    local bounds = {0}
+    vim.list_extend(bounds, idx.starts)
+    bounds[#bounds+1] = n + 1
+    for i = 1, #bounds - 1 do
+      if bounds[i + 1] > bounds[i] then
+        cells[#cells+1] = {bounds[i], bounds[i + 1]}
+      end
+    end
+  else
+    for _, lnum2 in ipairs(idx.stops) do
+      local lnum1 = idx.starts[count_le(idx.starts, lnum2 - 1)]
+      if lnum1 and lnum1 > prev then
+        cells[#cells+1] = {lnum1, lnum2}
+        prev = lnum2
+      end
+    end
+  end
+  if before == vim.NIL then
+    before = nil
+  end
+  for _, cell in ipairs(cells) do
+    if before and cell[2] > before then
+      break
+    end
+    local info = cell_info(buf, idx, cell)
+    if info.code:match('%S') then
+      res[#res+1] = info
+    end
+  end
+  return res
+end
+
+return M
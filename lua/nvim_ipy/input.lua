@@ -0,0 +1,73 @@
+-- non-modal answers to input_request messages, in a floating prompt buffer
+local api = vim.api
+
+local M = {}
+
+-- kernel name: its open prompt {win = win, buf = buf, prev = window to go
+-- back to}
+M.prompts = {}
+
+local function close(p)
+  if p ~= nil and api.nvim_win_is_valid(p.win) then
+    if api.nvim_get_current_win() == p.win then
+      if api.nvim_win_is_valid(p.prev) then
+        api.nvim_set_current_win(p.prev)
+      end
+      vim.cmd('stopinsert')
+    end
+    api.nvim_win_close(p.win, true)
+  end
+end
+
+-- close the prompt of kernel, if it has one
+function M.close(kernel)
+  close(M.prompts[kernel])
+  M.prompts[kernel] = nil
+end
+
+-- Show prompt in a one-line float over the last line of the window showing
+-- outbuf, or at the bottom of the editor, and start insert mode in it.
+-- Enter sends the line with IPyInputReply(), CTRL-C interrupts the kernel.
+function M.open(outbuf, kernel, prompt)
+  M.close(kernel)
+  local buf = api.nvim_create_buf(false, true)
+  api.nvim_buf_set_option(buf, 'buftype', 'prompt')
+  api.nvim_buf_set_option(buf, 'bufhidden', 'wipe')
+  api.nvim_buf_set_var(buf, 'ipy_kernel', kernel)
+  vim.fn.prompt_setprompt(buf, prompt)
+  vim.fn.prompt_setcallback(buf, function(text)
+    -- the buffer can't be wiped while its callback runs
+    local p = M.prompts[kernel]
+    M.prompts[kernel] = nil
+    vim.schedule(function()
+      close(p)
+    end)
+    vim.fn.IPyInputReply(text, kernel)
+  end)
+  vim.fn.prompt_setinterrupt(buf, function()
+    vim.fn.IPyInterrupt()
+  end)
+
+  -- prompts of other kernels at the bottom of the editor are stacked
+  local below = 0
+  for _, p in pairs(M.prompts) do
+    if p.bottom and api.nvim_win_is_valid(p.win) then
+      below = below + 1
+    end
+  end
+  local config = {relative = 'editor', row = math.max(vim.o.lines - vim.o.cmdheight - 3 - 3*below, 0), col = 0,
+                  width = vim.o.columns - 2, height = 1, style = 'minimal', border = 'single'}
+  local outwin = vim.fn.bufwinid(outbuf)
+  if outwin ~= -1 then
+    local height = api.nvim_win_get_height(outwin)
+    config = vim.tbl_extend('force', config, {relative = 'win', win = outwin,
+                            row = math.max(height - 3, 0),
+                            width = math.max(api.nvim_win_get_width(outwin) - 2, 1)})
+  end
+  local prev = api.nvim_get_current_win()
+  local win = api.nvim_open_win(buf, true, config)
+  M.prompts[kernel] = {win = win, buf = buf, prev = prev, bottom = outwin == -1}
+  vim.cmd('startinsert!')
+end
+
+return M
@@ -0,0 +1,370 @@
+-- rendering of kernel output into the [jupyter] buffer
+local api = vim.api
+
+local M = {}
+
+M.ns = api.nvim_create_namespace('nvim_ipy')
+-- marks at the start and end of the output of each execution
+M.exec_ns = api.nvim_create_namespace('nvim_ipy_exec')
+
+M.config = {
+  -- max number of lines/bytes in the output buffer, 0 is unlimited
+  scrollback = 0,
+  scrollback_bytes = 0,
+  -- file where trimmed lines are appended, if not empty
+  scrollback_log = '',
+  -- max number of highlight ranges per append, 0 is unlimited
+  max_highlights = 10000,
+}
+
+function M.configure(opts)
+  M.config = vim.tbl_extend('force', M.config, opts)
+end
+
+-- name: nvim_set_hl() attributes of the highlight groups defined for ANSI
+-- graphics states, kept to define them again after :colorscheme clears them
+M.hl_defs = {}
+
+function M.define_hl(defs)
+  if next(M.hl_defs) == nil then
+    vim.cmd([[
+      augroup nvim_ipy_hl
+        autocmd!
+        autocmd ColorScheme * lua require'nvim_ipy.output'.define_hl()
+      augroup END
+    ]])
+  end
+  for name, attrs in pairs(defs or M.hl_defs) do
+    M.hl_defs[name] = attrs
+    api.nvim_set_hl(0, name, attrs)
+  end
+end
+
+-- strip the last utf-8 character of s
+local function drop_char(s)
+  local i = #s
+  while i > 1 and s:byte(i) >= 0x80 and s:byte(i) < 0xc0 do
+    i = i - 1
+  end
+  return s:sub(1, i-1)
+end
+
+local function chunks_len(chunks)
+  local len = 0
+  for _, c in ipairs(chunks) do
+    len = len + #c[2]
+  end
+  return len
+end
+
+-- Append output to the end of buf. tokens is a list of {groups, text} chunks
+-- and the actions "\n", "\r" and "\b", as produced by the ANSI processor.
+-- extra_hls are {group, line, colstart, colend} with line relative to the
+-- first changed line, which is returned (0-based). If marks is given, an
+-- extmark is placed on each of these relative lines, and {row, mark_ids} is
+-- returned instead. A mark given as {line} is placed in M.exec_ns. defs are
+-- new highlight groups used by tokens, see M.define_hl.
+function M.append(buf, tokens, extra_hls, marks, defs)
+  -- None from python arrives as vim.NIL
+  if marks == vim.NIL then
+    marks = nil
+  end
+  if defs == vim.NIL then
+    defs = nil
+  end
+  if defs then
+    M.define_hl(defs)
+  end
+  local n = api.nvim_buf_line_count(buf)
+  local row = n - 1
+  local last = api.nvim_buf_get_lines(buf, row, n, false)[1]
+  -- bytes at the start of the last line that are left untouched
+  local keep = #last
+
+  local lines = {}
+  local chunks = {{{}, last}}
+  for _, tok in ipairs(tokens) do
+    if tok == '\n' then
+      lines[#lines+1] = chunks
+      chunks = {}
+    elseif tok == '\r' then
+      chunks = {}
+      if #lines == 0 then
+        keep = 0
+      end
+    elseif tok == '\b' then
+      while #chunks > 0 and chunks[#chunks][2] == '' do
+        chunks[#chunks] = nil
+      end
+      local c = chunks[#chunks]
+      if c then
+        c[2] = drop_char(c[2])
+        if #lines == 0 then
+          keep = math.min(keep, chunks_len(chunks))
+        end
+      end
+    else
+      chunks[#chunks+1] = tok
+    end
+  end
+  lines[#lines+1] = chunks
+
+  -- Highlights of adjacent chunks with the same group are merged into one
+  -- range, which can span lines. open[group] is {row, col, end_row, end_col,
+  -- ends_line} of the range that might still be extended.
+  local text = {}
+  local hls = {}
+  local open = {}
+  for i, line in ipairs(lines) do
+    local r = row+i-1
+    local parts = {}
+    local col = 0
+    for _, c in ipairs(line) do
+      local len = #c[2]
+      parts[#parts+1] = c[2]
+      if len > 0 then
+        for _, group in ipairs(c[1]) do
+          local o = open[group]
+          if o and ((o[3] == r and o[4] == col) or (o[5] and o[3] == r-1 and col == 0)) then
+            o[3], o[4] = r, col+len
+          else
+            if o then
+              hls[#hls+1] = {group, o[1], o[2], o[3], o[4]}
+            end
+            open[group] = {r, col, r, col+len}
+          end
+        end
+      end
+      col = col + len
+    end
+    for _, o in pairs(open) do
+      o[5] = o[3] == r and o[4] == col
+    end
+    text[i] = table.concat(parts)
+  end
+  for group, o in pairs(open) do
+    hls[#hls+1] = {group, o[1], o[2], o[3], o[4]}
+  end
+
+  -- only replace the changed part of the last line, to keep its highlights.
+  -- Highlights of the replaced part would be left collapsed, remove them.
+  if keep == 0 and #last > 0 then
+    api.nvim_buf_clear_namespace(buf, M.ns, row, row+1)
+  elseif keep < #last then
+    for _, m in ipairs(api.nvim_buf_get_extmarks(buf, M.ns, {row, keep}, {row, -1}, {})) do
+      api.nvim_buf_del_extmark(buf, M.ns, m[1])
+    end
+  end
+  text[1] = text[1]:sub(keep+1)
+  api.nvim_buf_set_text(buf, row, keep, row, #last, text)
+
+  -- beyond the limit, the rest of the text is left plain
+  local max = M.config.max_highlights
+  if max > 0 and #hls > max then
+    table.sort(hls, function(a, b)
+      return a[2] < b[2] or (a[2] == b[2] and a[3] < b[3])
+    end)
+  end
+  for i, hl in ipairs(hls) do
+    if max > 0 and i > max then
+      break
+    end
+    api.nvim_buf_set_extmark(buf, M.ns, hl[2], hl[3],
+                             {end_line = hl[4], end_col = hl[5], hl_group = hl[1]})
+  end
+  for _, hl in ipairs(extra_hls or {}) do
+    api.nvim_buf_add_highlight(buf, M.ns, hl[1], row+hl[2], hl[3], hl[4])
+  end
+  local ids = {}
+  for i, line in ipairs(marks or {}) do
+    local ns = M.ns
+    if type(line) == 'table' then
+      ns, line = M.exec_ns, line[1]
+    end
+    ids[i] = api.nvim_buf_set_extmark(buf, ns, row+line, 0, {})
+  end
+
+  local cut = M.trim(buf)
+  M.scroll(buf)
+  row = math.max(row - cut, 0)
+  if marks then
+    return {row, ids}
+  end
+  return row
+end
+
+-- ids of extmarks on the cursor line, if buf is the current buffer
+function M.marks_at_cursor(buf)
+  if api.nvim_get_current_buf() ~= buf then
+    return {}
+  end
+  local row = api.nvim_win_get_cursor(0)[1] - 1
+  local ids = {}
+  for _, m in ipairs(api.nvim_buf_get_extmarks(buf, M.ns, {row, 0}, {row, -1}, {})) do
+    ids[#ids+1] = m[1]
+  end
+  return ids
+end
+
+-- Replace the line with extmark id by lines, and remove the mark. Nothing is
+-- done unless the line still contains the text `expect` (it might have been
+-- trimmed or edited).
+function M.replace_mark_line(buf, id, expect, lines)
+  local pos = api.nvim_buf_get_extmark_by_id(buf, M.ns, id, {})
+  if #pos == 0 then
+    return false
+  end
+  if api.nvim_buf_get_lines(buf, pos[1], pos[1]+1, false)[1] ~= expect then
+    return false
+  end
+  api.nvim_buf_del_extmark(buf, M.ns, id)
+  api.nvim_buf_set_lines(buf, pos[1], pos[1]+1, false, lines)
+  return true
+end
+
+-- mark the end of the output of an execution, at the last line
+function M.mark_end(buf)
+  local row = api.nvim_buf_line_count(buf) - 1
+  -- output appended later is inserted at this very position, and must go
+  -- after the mark
+  return api.nvim_buf_set_extmark(buf, M.exec_ns, row, 0, {right_gravity = false})
+end
+
+-- id of the last execution start mark at or before the cursor, if buf is
+-- the current buffer
+function M.exec_at_cursor(buf)
+  if api.nvim_get_current_buf() ~= buf then
+    return nil
+  end
+  local row = api.nvim_win_get_cursor(0)[1] - 1
+  local marks = api.nvim_buf_get_extmarks(buf, M.exec_ns, {row, -1}, 0, {limit = 1})
+  return marks[1] and marks[1][1]
+end
+
+-- 0-based [start, stop) rows of an execution output, which continues to the
+-- end of buf while there is no end mark
+local function exec_range(buf, start_id, end_id)
+  local start = api.nvim_buf_get_extmark_by_id(buf, M.exec_ns, start_id, {})
+  if #start == 0 then
+    return nil
+  end
+  local stop = {}
+  if end_id ~= nil and end_id ~= vim.NIL then
+    stop = api.nvim_buf_get_extmark_by_id(buf, M.exec_ns, end_id, {})
+  end
+  return start[1], stop[1] or api.nvim_buf_line_count(buf)
+end
+
+-- move the cursor to the output of an execution, in the current window if it
+-- shows buf, else in the first window that does
+function M.exec_jump(buf, start_id)
+  local row = exec_range(buf, start_id)
+  if row == nil then
+    return false
+  end
+  local win = api.nvim_get_current_win()
+  if api.nvim_win_get_buf(win) ~= buf then
+    win = vim.fn.win_findbuf(buf)[1]
+    if win == nil then
+      return false
+    end
+    api.nvim_set_current_win(win)
+  end
+  api.nvim_win_set_cursor(win, {row+1, 0})
+  return true
+end
+
+-- fold the output of an execution in all windows showing buf
+function M.exec_fold(buf, start_id, end_id)
+  local start, stop = exec_range(buf, start_id, end_id)
+  if start == nil or stop - start < 2 then
+    return false
+  end
+  for _, win in ipairs(vim.fn.win_findbuf(buf)) do
+    api.nvim_win_call(win, function()
+      pcall(vim.cmd, string.format('%d,%dfold', start+1, stop))
+    end)
+  end
+  return true
+end
+
+function M.exec_lines(buf, start_id, end_id)
+  local start, stop = exec_range(buf, start_id, end_id)
+  if start == nil then
+    return {}
+  end
+  return api.nvim_buf_get_lines(buf, start, stop, false)
+end
+
+-- delete the output of an execution, and its marks
+function M.exec_clear(buf, start_id, end_id)
+  local start, stop = exec_range(buf, start_id, end_id)
+  if start == nil then
+    return false
+  end
+  api.nvim_buf_set_lines(buf, start, stop, false, {})
+  api.nvim_buf_del_extmark(buf, M.exec_ns, start_id)
+  if end_id ~= nil and end_id ~= vim.NIL then
+    api.nvim_buf_del_extmark(buf, M.exec_ns, end_id)
+  end
+  return true
+end
+
+-- Enforce the scrollback limits, by deleting lines from the start of buf.
+-- To avoid doing this on every append, the buffer is trimmed to 90% of the
+-- limits. Returns the number of deleted lines.
+function M.trim(buf)
+  local max_lines, max_bytes = M.config.scrollback, M.config.scrollback_bytes
+  if max_lines <= 0 and max_bytes <= 0 then
+    return 0
+  end
+  local n = api.nvim_buf_line_count(buf)
+  local cut = 0
+  if max_lines > 0 and n > max_lines then
+    cut = n - math.floor(max_lines * 0.9)
+  end
+  if max_bytes > 0 then
+    local size = api.nvim_buf_get_offset(buf, n)
+    if size > max_bytes then
+      -- first line such that the rest fits in the budget
+      local target = size - math.floor(max_bytes * 0.9)
+      local lo, hi = 0, n
+      while lo < hi do
+        local mid = math.floor((lo + hi) / 2)
+        if api.nvim_buf_get_offset(buf, mid) < target then
+          lo = mid + 1
+        else
+          hi = mid
+        end
+      end
+      cut = math.max(cut, lo)
+    end
+  end
+  -- the last line might still be written to
+  cut = math.min(cut, n - 1)
+  if cut <= 0 then
+    return 0
+  end
+
+  local log = M.config.scrollback_log
+  if log ~= '' then
+    vim.fn.writefile(api.nvim_buf_get_lines(buf, 0, cut, false), vim.fn.expand(log), 'a')
+  end
+  -- highlights are extmarks, and follow the remaining text
+  api.nvim_buf_set_lines(buf, 0, cut, false, {})
+  return cut
+end
+
+-- scroll windows showing buf to the end, except the current one
+function M.scroll(buf)
+  local cur = api.nvim_get_current_win()
+  local n = api.nvim_buf_line_count(buf)
+  local col = #api.nvim_buf_get_lines(buf, n-1, n, false)[1]
+  for _, w in ipairs(vim.fn.win_findbuf(buf)) do
+    if w ~= cur then
+      api.nvim_win_set_cursor(w, {n, col})
+    end
+  end
+end
+
+return M
@@ -1,16 +1,31 @@
 command! -nargs=* IPython :call IPyConnect(<f-args>)
 command! -nargs=* IPython2 :call IPyConnect("--kernel", "python2")
 command! -nargs=* IJulia :call IPyConnect("--kernel", "julia-0.4")
+command! -nargs=1 IPyKernel :let b:ipy_kernel = <q-args>
+command! IPyExpand :call IPyExpand()
+command! -nargs=? IPyJump :call IPyJump(<f-args>)
+command! -nargs=? IPyFold :call IPyFold(<f-args>)
+command! -nargs=? IPyClear :call IPyClear(<f-args>)
+command! -nargs=* IPyCopy :call IPyCopy(<f-args>)
+command! IPyRunAllCells :call IPyRunAllCells()
+command! -bang IPyRunStaleCells :call IPyRunStale(<bang>0 ? 1 : get(g:, 'ipy_stale_downstream', 0))
+command! -nargs=* IPyOpenOutput :call IPyOpenOutput(<f-args>)
+command! -nargs=+ -complete=file IPyExportOutput :call IPyExportOutput(<f-args>)
 
 nnoremap <Plug>(IPy-Word) <Cmd>call IPyRun(expand("<cword>"))<cr>
 nnoremap <Plug>(IPy-Run) <Cmd>call IPyRun(getline('.')."\n")<cr>
 vnoremap <Plug>(IPy-Run) :<c-u>call IPyRun(<SID>get_selection(v:false))<cr>
 nnoremap <Plug>(IPy-RunCell) <Cmd>call IPyRunCell()<cr>
+nnoremap <Plug>(IPy-RunNextCell) <Cmd>call IPyRunNextCell()<cr>
+nnoremap <Plug>(IPy-RunCellsAbove) <Cmd>call IPyRunCellsAbove()<cr>
+nnoremap <Plug>(IPy-RunAllCells) <Cmd>call IPyRunAllCells()<cr>
+nnoremap <Plug>(IPy-RunStaleCells) <Cmd>call IPyRunStale()<cr>
 nnoremap <Plug>(IPy-RunAll) :call IPyRun(join(getline(1, '$'), "\n"))<cr>
 noremap <Plug>(IPy-RunOp) <cmd>set opfunc=IPyOpFunc<cr>g@
 inoremap <Plug>(IPy-Complete) <Cmd>call IPyComplete()<cr>
 noremap <Plug>(IPy-WordObjInfo) :call IPyObjInfo(<SID>get_current_word(), 0)<cr>
 noremap <Plug>(IPy-Interrupt) <Cmd>call IPyInterrupt()<cr>
+noremap <Plug>(IPy-CancelQueued) <Cmd>call IPyCancelQueued()<cr>
 noremap <Plug>(IPy-Terminate) <Cmd>call IPyTerminate()<cr>
 
 " make this overrideable
@@ -55,64 +70,66 @@ function! s:get_scoped(key,default)
     end
 endfunction
 
-function! s:saveCur()
-    " from matchit
-    let restore_cursor = virtcol(".") . "|"
-    normal! g0
-    let restore_cursor = line(".") . "G" .  virtcol(".") . "|zs" . restore_cursor
-    normal! H
-    let restore_cursor = "normal!" . line(".") . "Gzt" . restore_cursor
-    execute restore_cursor
-    return restore_cursor
+" [start, end] patterns of the cells, end is '' for implicit cells
+function! s:celldef()
+    let def = s:get_scoped("ipy_celldef", "^##")
+    return type(def) == v:t_list ? def : [def, '']
 endfunction
 
-function! s:select(mode, start, end)
-    execute "normal! ".a:mode
-    call cursor(a:start[0], a:start[1])
-    normal! o
-    call cursor(a:end[0], a:end[1])
-    if &selection ==# 'exclusive'
-        normal! l
-    endif
+" cell boundaries are indexed by lua/nvim_ipy/cells.lua, and kept up to date
+" as the buffer changes
+function! s:cell(lnum)
+    return luaeval("require'nvim_ipy.cells'.cell(0, _A[1], _A[2], _A[3])",
+                \ s:celldef() + [a:lnum])
 endfunction
 
-
-" TODO: make me a reusable text object
 function! IPyRunCell()
-    let def = s:get_scoped("ipy_celldef", "^##")
-    if type(def) == v:t_list
-        let implicit = v:false
-        let [start, end] = def
-    else
-        let implicit = v:true
-        let start = def
-        let end = def
-    endif
-    let curline = line('.')
-    let lnum2 = search(end, 'nW')
-    if lnum2 == 0
-        if implicit
-            let lnum2 = line('$')+1
-        else
-            return 0
-        end
+    let cell = s:cell(line('.'))
+    if empty(cell)
+        return 0
     endif
-    let reset =  s:saveCur()
-    call cursor(lnum2,1)
-    let lnum1 = search(start, 'bnW')
-    execute reset
-    if lnum1 == 0 && !implicit
+    call IPyRun(cell.code)
+    return 1
+endfunction
+
+" run the current cell, and move to the next one
+function! IPyRunNextCell()
+    let cell = s:cell(line('.'))
+    if empty(cell)
         return 0
     endif
-    let lines = getline(lnum1+1, lnum2-1)
-    echomsg "".lnum1.":".lnum2
-    while len(lines) > 0 && match(lines[0], '^\s*$') > -1
-        let lines = lines[1:]
-    endwhile
-    call IPyRun(join(lines, "\n"))
+    call IPyRun(cell.code)
+    call cursor(cell.next, 1)
     return 1
 endfunction
 
+" cells ending before line `before` (all cells if v:null)
+function! s:cells(before)
+    return luaeval("require'nvim_ipy.cells'.cells(0, _A[1], _A[2], _A[3])",
+                 \ s:celldef() + [a:before])
+endfunction
+
+function! IPyRunCellsAbove()
+    let cell = s:cell(line('.'))
+    let cells = s:cells(empty(cell) ? line('.') : cell.start - 1)
+    call IPyRunCells(cells)
+    return len(cells)
+endfunction
+
+" run each cell as a separate execution, reporting the time of each
+function! IPyRunAllCells()
+    let cells = s:cells(v:null)
+    call IPyRunCells(cells)
+    return len(cells)
+endfunction
+
+" run the cells changed since they were last executed successfully, and with
+" a:1 (default g:ipy_stale_downstream) also all cells after them
+function! IPyRunStale(...)
+    let downstream = a:0 > 0 ? a:1 : get(g:, 'ipy_stale_downstream', 0)
+    call IPyRunStaleCells(s:cells(v:null), downstream)
+endfunction
+
 function! IPyOpFunc(kind)
     call IPyRun(s:get_selection(v:true))
 endfunction
@@ -123,6 +140,7 @@ if !exists('g:nvim_ipy_perform_mappings')
 endif
 
 let g:ipy_status = ""
+let g:ipy_queue = 0
 
 if g:nvim_ipy_perform_mappings
     map <silent> <F5>           <Plug>(IPy-Run)
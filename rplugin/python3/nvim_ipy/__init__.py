@@ -1,24 +1,65 @@
 from __future__ import print_function, division
 from functools import partial, wraps
-from collections import deque
+from collections import deque, OrderedDict
 import os, sys
+import atexit
+import threading
 import json
+import hashlib
 import re
+import time
 import neovim
 from neovim.api import NvimError
 
-from itertools import chain
-
-from jupyter_client import KernelManager
-from jupyter_client.threaded import ThreadedKernelClient
-from jupyter_core.application import JupyterApp
-from jupyter_client.consoleapp import JupyterConsoleApp
-from jupyter_core import version_info
-
 import greenlet
 from traceback import format_exc
 
-from .ansi_code_processor import AnsiCodeProcessor, NewLineAction, CarriageReturnAction, BackSpaceAction
+from .pending import PendingRequests, RequestTimeout, FOREVER
+from .execution import ExecutionQueue
+from .stats import Stats
+from .outputs import OutputStore, EXTENSIONS
+from .highlight import HighlightRegistry
+from .health import HealthMonitor, ReplayFilter, RecentIds
+from .ansi_code_processor import (AnsiCodeProcessor, NewLineAction, CarriageReturnAction,
+                                  BackSpaceAction, collapse_carriage_returns, ANSI_RE)
+
+# mode, text before the cursor and current line, for completion
+CURSOR_STATE_LUA = """
+local col = vim.api.nvim_win_get_cursor(0)[2]
+local line = vim.api.nvim_get_current_line()
+return {vim.api.nvim_get_mode().mode, line:sub(1, col), line}
+"""
+
+WORD_END = re.compile(r'\w*$')
+
+def code_hash(code):
+    """Identifies the source of a cell, to know if it was already executed."""
+    return hashlib.sha1(code.encode('utf-8')).hexdigest()
+
+# placeholder for the lines of output hidden by truncation
+TRUNCATED_MARKER = u'..... ({} more lines, :IPyExpand to show)'
+# number of truncated outputs which can be expanded
+MAX_TRUNCATED = 100
+# characters of hidden text kept for them, outputs are read back from the
+# output store instead
+MAX_TRUNCATED_CHARS = 4<<20
+
+# MIME types opened or exported by default, most preferred first
+MIME_PREFERENCE = ['image/png', 'image/svg+xml', 'image/jpeg', 'image/gif',
+                   'application/pdf', 'text/html', 'text/latex', 'text/markdown']
+
+# name of the session when IPyConnect isn't given --name
+DEFAULT_KERNEL = 'default'
+
+# longest wait between two attempts to reconnect to an unresponsive kernel
+MAX_RECONNECT_DELAY = 30
+
+# how actions are sent to the lua renderer
+ACTION_TOKENS = {
+    NewLineAction: '\n',
+    CarriageReturnAction: '\r',
+    BackSpaceAction: '\b',
+}
 
 # from http://serverfault.com/questions/71285/in-centos-4-4-how-can-i-strip-escape-sequences-from-a-text-file
 strip_ansi = re.compile('\x1B\[([0-9]{1,2}(;[0-9]{1,2})?)?[m|K]')
@@ -31,55 +72,6 @@ if 'NVIM_IPY_DEBUG_FILE' in os.environ:
     logger.addHandler(logging.FileHandler(logfile, 'w'))
     logger.level = logging.DEBUG
 
-class RedirectingKernelManager(KernelManager):
-    def _launch_kernel(self, cmd, **b):
-        # stdout is used to communicate with nvim, redirect it somewhere else
-        nullfile = "/dev/null" if os.name != 'nt' else 'NUL'
-        self._null = open(nullfile,"wb",0)
-        b['stdout'] = self._null.fileno()
-        b['stderr'] = self._null.fileno()
-        return super(RedirectingKernelManager, self)._launch_kernel(cmd, **b)
-
-# because Dependency Injection
-def fakefactory(factory, handler):
-    class theclass(factory):
-        call_handlers = handler
-    return theclass
-
-class JupyterVimApp(JupyterApp, JupyterConsoleApp):
-    # don't use blocking client; we override call_handlers below
-    kernel_client_class = ThreadedKernelClient
-    kernel_manager_class = RedirectingKernelManager
-    aliases = JupyterConsoleApp.aliases #this the way?
-    flags = JupyterConsoleApp.flags
-    def init_kernel_client(self):
-        #TODO: cleanup this (by subclassing kernel_clinet or something)
-        if self.kernel_manager is not None:
-            self.kernel_client = self.kernel_manager.client()
-        else:
-            self.kernel_client = self.kernel_client_class(
-                                session=self.session,
-                                ip=self.ip,
-                                transport=self.transport,
-                                shell_port=self.shell_port,
-                                iopub_port=self.iopub_port,
-                                stdin_port=self.stdin_port,
-                                hb_port=self.hb_port,
-                                connection_file=self.connection_file,
-                                parent=self,
-            )
-        self.kernel_client.shell_channel_class = fakefactory(self.kernel_client.shell_channel_class, self.target.on_shell_msg)
-        self.kernel_client.iopub_channel_class = fakefactory(self.kernel_client.iopub_channel_class, self.target.on_iopub_msg)
-        self.kernel_client.stdin_channel_class = fakefactory(self.kernel_client.stdin_channel_class, self.target.on_stdin_msg)
-        self.kernel_client.hb_channel_class = fakefactory(self.kernel_client.hb_channel_class, self.target.on_hb_msg)
-        self.kernel_client.start_channels()
-
-    def initialize(self, target, argv):
-        self.target = target
-        super(JupyterVimApp, self).initialize(argv)
-        JupyterConsoleApp.initialize(self, argv)
-
-
 class Async(object):
     """Wrapper that defers all method calls on a plugin object to the event
     loop, given that the object has vim attribute"""
@@ -89,6 +81,50 @@ class Async(object):
     def __getattr__(self, name):
         return partial(self.wraps.vim.async_call, getattr(self.wraps, name))
 
+class Dispatcher(object):
+    """Like Async, but for calls from the Jupyter channel threads.
+
+    Calls are put on a single queue, and the event loop is woken only when
+    the queue was empty. One scheduled call then runs everything queued so
+    far, each call in its own greenlet like async_call does, so that one
+    waiting on nvim doesn't hold up the rest.
+    """
+    def __init__(self, wraps):
+        self.wraps = wraps
+        self.queue = deque()
+        self.lock = threading.Lock()
+        self.scheduled = False
+
+    def __getattr__(self, name):
+        method = getattr(self.wraps, name)
+        def post(*args):
+            with self.lock:
+                self.queue.append((method, args))
+                if self.scheduled:
+                    return
+                self.scheduled = True
+            self.wraps.vim.async_call(self.drain)
+        return post
+
+    def drain(self):
+        while True:
+            with self.lock:
+                if not self.queue:
+                    self.scheduled = False
+                    return
+                batch = list(self.queue)
+                self.queue.clear()
+            for method, args in batch:
+                greenlet.greenlet(self._call).switch(method, args)
+
+    def _call(self, method, args):
+        # catch here, as the handler might be resumed from a response
+        # callback after waiting on nvim, and not return to drain
+        try:
+            method(*args)
+        except Exception:
+            error("Error in %s: %s", method.__name__, format_exc())
+
 class ExclusiveHandler(object):
     """Wrapper for buffering incoming messages from a asynchronous source.
 
@@ -105,22 +141,116 @@ class ExclusiveHandler(object):
         self.msgs.append(msg)
         if not self.is_active:
             self.is_active = True
-            while self.msgs:
-                self.handler(self.msgs.popleft())
-            self.is_active = False
-
-@neovim.plugin
-@neovim.encoding(True)
-class IPythonPlugin(object):
-    def __init__(self, vim):
+            try:
+                while self.msgs:
+                    self.handler(self.msgs.popleft())
+            finally:
+                # an error must not keep the following messages waiting
+                self.is_active = False
+
+class CompletionCache(object):
+    """Recent completion results, keyed by the text before the cursor and
+    the execution count of the kernel.
+
+    When more identifier characters have been typed since a cached request,
+    its matches are filtered locally instead of asking the kernel again.
+    """
+    def __init__(self, size=64):
+        self.entries = OrderedDict()
+        self.size = size
+
+    def add(self, prefix, count, start, matches):
+        self.entries[(prefix, count)] = (start, matches)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+
+    def lookup(self, prefix, count):
+        """Returns (cursor_start, matches) or None."""
+        word_start = WORD_END.search(prefix).start()
+        for end in range(len(prefix), word_start-1, -1):
+            key = (prefix[:end], count)
+            entry = self.entries.get(key)
+            if entry is None:
+                continue
+            start, matches = entry
+            if start > end:
+                continue
+            # most recently used goes last
+            self.entries[key] = self.entries.pop(key)
+            if end < len(prefix):
+                token = prefix[start:]
+                matches = [m for m in matches if m.startswith(token)]
+            return start, matches
+        return None
+
+class KernelSession(object):
+    """A connection to one kernel, with its own output buffer and state."""
+    def __init__(self, vim, name, kernel_pool=None):
         self.vim = vim
+        self.name = name
+        self.kernel_pool = kernel_pool
         self.buf = None
         self.has_connection = False
 
-        self.pending_shell_msgs = {}
+        self.pending_shell_msgs = PendingRequests()
+        self.sweep_timer = None
+
+        self.dispatcher = Dispatcher(self)
+
+        self.exec_queue = ExecutionQueue(self.send_execute, on_change=self.disp_queue)
+        self.queue_depth = None
+
+        self.execution_count = 0
+        self.completions = CompletionCache()
+        self.completion_active = False
+        self.completion_again = False
+
+        # stream text not yet written to the output buffer
+        self.stream_pending = []
+        self.stream_size = 0
+        self.stream_timer = None
+        self.stream_recv = None
+        self.last_redraw = 0
 
         # make sure one message is handled at a time
-        self.on_iopub_msg = ExclusiveHandler(self._on_iopub_msg)
+        self.iopub_handler = ExclusiveHandler(self._on_iopub_msg)
+
+        self.stats = Stats()
+
+        # mark id: (placeholder line, hidden text or (output key, offset))
+        self.truncated = OrderedDict()
+        self.truncated_chars = 0
+
+        self.outputs = OutputStore()
+        atexit.register(self.outputs.close)
+
+        # sha1 of code executed successfully in this kernel: execution_count
+        self.executed = {}
+
+        # execution_count: [start mark, end mark or None] of its output
+        self.exec_marks = OrderedDict()
+        # msg_id of the execute_request: execution_count
+        self.exec_by_msg = {}
+        # start or end mark: execution_count
+        self.exec_by_mark = {}
+        # finished executions to fold, with g:ipy_fold_finished
+        self.fold_pending = []
+        # msg_id of the execute_request: callbacks for when its output is done
+        self.on_idle = {}
+        # msg_ids of the last executions whose idle status was handled
+        self.idle_done = RecentIds(100)
+
+        # input_request messages not answered yet, the first one is shown
+        self.input_requests = deque()
+
+        self.health = HealthMonitor()
+        self.replay_filter = ReplayFilter()
+        self.reconnect_timer = None
+        # delay before the next reconnect, None until one was tried
+        self.reconnect_delay = None
 
     def configure(self):
         #FIXME: rethink the entire configuration interface thing
@@ -128,6 +258,30 @@ class IPythonPlugin(object):
         self.do_filetype = self.vim.vars.get("ipy_set_ft", 0)
         self.do_highlight = self.vim.vars.get("ipy_highlight", 1)
         self.max_in = self.vim.vars.get("ipy_truncate_input", 0)
+        self.max_out = self.vim.vars.get("ipy_truncate_output", 0)
+        self.max_out_chars = self.vim.vars.get("ipy_truncate_output_chars", 1000000)
+        self.fold_finished = self.vim.vars.get("ipy_fold_finished", 0)
+        self.input_mode = self.vim.vars.get("ipy_input_mode", "float")
+        self.auto_reconnect = self.vim.vars.get("ipy_reconnect", 1)
+        self.reconnect_after = self.vim.vars.get("ipy_reconnect_after", 3)
+        self.pending_shell_msgs.default_timeout = self.vim.vars.get("ipy_timeout", 30)
+        # IPyOmniFunc blocks nvim while waiting
+        self.omnifunc_timeout = self.vim.vars.get("ipy_omnifunc_timeout", 5)
+        self.exec_queue.max_inflight = self.vim.vars.get("ipy_max_inflight", 4)
+        self.stats.log = bool(self.vim.vars.get("ipy_stats_log", 0))
+        self.stream_flush_delay = self.vim.vars.get("ipy_stream_flush_ms", 20) / 1000
+        self.stream_flush_size = self.vim.vars.get("ipy_stream_flush_size", 65536)
+        self.progress_interval = self.vim.vars.get("ipy_progress_interval_ms", 50) / 1000
+        self.outputs.memory_budget = self.vim.vars.get("ipy_output_memory", 32<<20)
+        self.outputs.disk_budget = self.vim.vars.get("ipy_output_disk", 1<<30)
+        default_viewer = 'open' if sys.platform == 'darwin' else 'xdg-open'
+        self.output_viewer = self.vim.vars.get("ipy_output_viewer", default_viewer)
+        self.vim.api.exec_lua("require'nvim_ipy.output'.configure(...)", [{
+            'scrollback': self.vim.vars.get("ipy_scrollback", 0),
+            'scrollback_bytes': self.vim.vars.get("ipy_scrollback_bytes", 0),
+            'scrollback_log': self.vim.vars.get("ipy_scrollback_log", ""),
+            'max_highlights': self.vim.vars.get("ipy_max_highlights", 10000),
+        }])
         if self.vim.vars.get("ipy_shortprompt", False):
             self.prompt_in = u"{}: "
             self.prompt_out = u"{}: "
@@ -144,7 +298,8 @@ class IPythonPlugin(object):
         buf = vim.current.buffer
         buf.options["swapfile"] = False
         buf.options["buftype"] = "nofile"
-        buf.name = "[jupyter]"
+        buf.name = "[jupyter]" if self.name == DEFAULT_KERNEL else "[jupyter:{}]".format(self.name)
+        buf.vars["ipy_kernel"] = self.name
 
         if not window:
             vim.command(":q")
@@ -153,72 +308,164 @@ class IPythonPlugin(object):
         self.buf = buf
         self.hl_handler = AnsiCodeProcessor()
         self.hl_handler.bold_text_enabled = True
+        self.highlights = HighlightRegistry(self.vim.vars.get("ipy_max_hl_groups", 1024))
+
+    def append_outbuf(self, data, extra_hls=()):
+        """Append text with ANSI codes to the output buffer, using a single RPC.
+
+        extra_hls are [group, line, colstart, colend] highlights, with line
+        relative to the returned index of the first changed line.
+        """
+        return self._append_outbuf(data, extra_hls)
+
+    def append_outbuf_marked(self, data, marks, extra_hls=()):
+        """Like append_outbuf, but also places an extmark on each line in marks
+        (relative like extra_hls), and returns (lineidx, mark_ids)."""
+        return self._append_outbuf(data, extra_hls, marks)
+
+    def _append_outbuf(self, data, extra_hls, marks=None):
+        # the line building and CR/BS handling is done by lua, we only send
+        # the split up chunks
+        t0 = time.time()
+        hl = self.hl_handler
+        lines = hl.split_lines(data)
+        if lines is not None:
+            # fast path: no escape codes or special characters
+            groups = self.hl_groups()
+            tokens = ['\n'] * (2*len(lines)-1)
+            tokens[::2] = [[groups, line] for line in lines]
+        else:
+            tokens = []
+            for chunk in hl.split_string(data):
+                if hl.actions:
+                    assert len(hl.actions) == 1
+                    tok = ACTION_TOKENS.get(type(hl.actions[0]))
+                    if tok is not None:
+                        tokens.append(tok)
+                elif len(chunk) > 0:
+                    groups = self.hl_groups()
+                    if tokens and not isinstance(tokens[-1], str) and tokens[-1][0] is groups:
+                        # same style, for instance after an escape code that
+                        # changed nothing shown
+                        tokens[-1][1] += chunk
+                    else:
+                        tokens.append([groups, chunk])
+
+        res = self.vim.api.exec_lua("return require'nvim_ipy.output'.append(...)",
+                                    [self.buf, tokens, extra_hls, marks,
+                                     self.highlights.take_pending()])
+        self.stats.since('render', t0)
+        return res
+
+    def truncate_output(self, text):
+        """Split text into the part to show and the part to hide (or None),
+        according to g:ipy_truncate_output and g:ipy_truncate_output_chars."""
+        cut = len(text)
+        if self.max_out_chars:
+            cut = min(cut, self.max_out_chars)
+        if self.max_out:
+            pos = -1
+            for i in range(self.max_out):
+                pos = text.find('\n', pos+1, cut)
+                if pos < 0:
+                    break
+            else:
+                cut = pos
+        if cut >= len(text):
+            return text, None
+        # prefer to cut at a line break
+        pos = text.rfind('\n', 0, cut+1)
+        if pos > 0:
+            cut = pos
+            return text[:cut], text[cut+1:]
+        return text[:cut], text[cut:]
+
+    def append_truncated(self, text, hidden, extra_hls=(), marks=(), source=None):
+        """Append text followed by a placeholder for the hidden text, which
+        can be shown with IPyExpand. Returns the ids of the extra marks.
+
+        source is the (key, offset) of the hidden text in the text/plain
+        data of the output store, so that it isn't kept twice."""
+        marker = TRUNCATED_MARKER.format(hidden.count('\n')+1)
+        line = text.count('\n')
+        extra_hls = list(extra_hls) + [['Comment', line, 0, -1]]
+        lineidx, ids = self.append_outbuf_marked(text + marker + '\n', list(marks) + [line],
+                                                 extra_hls)
+        if source is None:
+            self.truncated[ids[-1]] = (marker, hidden)
+            self.truncated_chars += len(hidden)
+        else:
+            self.truncated[ids[-1]] = (marker, source)
+        while self.truncated and (len(self.truncated) > MAX_TRUNCATED or
+                                  self.truncated_chars > MAX_TRUNCATED_CHARS):
+            marker, hidden = self.truncated.popitem(last=False)[1]
+            if not isinstance(hidden, tuple):
+                self.truncated_chars -= len(hidden)
+        return ids[:-1]
+
+    def pop_truncated(self, mark):
+        """Forget the hidden text of mark, and return (placeholder, text).
+        The text is None when the output is not stored anymore."""
+        marker, hidden = self.truncated.pop(mark)
+        if not isinstance(hidden, tuple):
+            self.truncated_chars -= len(hidden)
+            return marker, hidden
+        key, offset = hidden
+        data = self.outputs.get(key, 'text/plain')
+        return marker, None if data is None else data.decode('utf-8')[offset:]
+
+    def hl_groups(self):
+        """Highlight groups for the current ANSI state."""
+        if not self.do_highlight:
+            return []
+        hl = self.hl_handler
+        return self.highlights.groups(hl.foreground_color, hl.background_color,
+                                      hl.bold or hl.intensity > 0, hl.italic, hl.underline)
+
+    def write_stream(self, text, recv=None):
+        # consecutive stream messages are merged, and written at most once
+        # per flush interval, so a flood of prints costs a bounded amount of
+        # buffer updates
+        if not self.stream_pending:
+            self.stream_recv = recv
+        self.stream_pending.append(text)
+        self.stream_size += len(text)
+        if '\r' in text:
+            # only the last state of a progress bar needs to be kept around
+            data = collapse_carriage_returns(''.join(self.stream_pending))
+            self.stream_pending = [data]
+            self.stream_size = len(data)
+        if self.stream_size >= self.stream_flush_size or not self.stream_flush_delay:
+            self.flush_stream()
+        else:
+            self.schedule_flush(self.stream_flush_delay)
 
-    def append_outbuf(self, data):
-        #self.hl_handler.reset_sgr()
-        lineidx = len(self.buf)-1
-        lastline = self.buf[-1]
-
-        lines = []
-        chunks = []
-
-        #self.hl_handler.actions = []
-
-        for chunk in chain([lastline], self.hl_handler.split_string(data)):
-            if self.hl_handler.actions:
-                assert len(self.hl_handler.actions) == 1
-                a = self.hl_handler.actions[0]
-                if isinstance(a, NewLineAction):
-                    lines.append(chunks)
-                    chunks = []
-                elif isinstance(a, CarriageReturnAction):
-                    chunks = []
-                elif isinstance(a, BackSpaceAction):
-                    if chunks:
-                        if len(chunks[-1]) > 1:
-                            chunks[-1][1] = chunks[-1][1][:-1]
-                        else:
-                            chunks.pop()
-            elif len(chunk) > 0:
-                groups = []
-                if self.do_highlight:
-                    bold = self.hl_handler.bold or self.hl_handler.intensity > 0
-                    color = self.hl_handler.foreground_color
-                    if color and color > 16: color = None
-
-                    if color is not None:
-                        if bold and color < 8:
-                            color += 8 # be bright and shiny
-                        groups.append("IPyFg{}".format(color))
-
-                    if bold:
-                        groups.append("IPyBold")
-                chunks.append([groups, chunk])
-
-        lines.append(chunks)
-        chunks = []
-
-        #TODO: at least this part should be lua:
-        textlines = []
-        hls = []
-        for i,line in enumerate(lines):
-            text = ''.join(c[1] for c in line)
-            textlines.append(text)
-            colend = 0
-            for chunk in line:
-                colstart = colend
-                colend = colstart + len(chunk[1])
-                for hl in chunk[0]:
-                    hls.append([hl,lineidx+i,colstart,colend])
-
-        self.buf[-1:] = textlines
-        calls = [["nvim_buf_add_highlight", [self.buf, -1]+hl] for hl in hls]
-        self.vim.api.call_atomic(calls)
-
-        for w in self.vim.windows:
-            if w.buffer == self.buf and w != self.vim.current.window:
-                w.cursor = [len(self.buf), int(1e9)]
-        return lineidx
+    def schedule_flush(self, delay):
+        if self.stream_timer is None:
+            # flush via the iopub handler, so it is ordered with other output
+            self.stream_timer = self.vim.loop.call_later(
+                delay, self.vim.async_call, self.on_iopub_msg, None)
+
+    def flush_stream(self, throttle=False):
+        if not self.stream_pending:
+            return
+        data = collapse_carriage_returns(''.join(self.stream_pending))
+        if '\n' not in data:
+            # only the last line is rewritten, like a progress bar. There is
+            # no point in redrawing it more often than progress_interval.
+            now = time.time()
+            wait = self.last_redraw + self.progress_interval - now
+            if throttle and wait > 0:
+                self.stream_pending = [data]
+                self.stream_size = len(data)
+                self.schedule_flush(wait)
+                return
+            self.last_redraw = now
+        self.stream_pending = []
+        self.stream_size = 0
+        recv, self.stream_recv = self.stream_recv, None
+        self.append_outbuf(data)
+        self.stats.since('output_latency', recv)
 
     def connect(self, argv):
         vim = self.vim
@@ -226,22 +473,45 @@ class IPythonPlugin(object):
         has_previous = self.has_connection
         if has_previous:
             # TODO: kill last kernel if we owend it?
-            JupyterVimApp.instance().kernel_client.stop_channels()
-            JupyterVimApp.clear_instance()
-
-        self.ip_app = JupyterVimApp.instance()
-        if has_previous:
-            self.ip_app.connection_file = self.ip_app._new_connection_file()
+            self.ip_app.kernel_client.stop_channels()
+            # nothing will reply to requests sent to the previous kernel
+            self.sweep_requests(FOREVER)
+
+        if self.reconnect_timer is not None:
+            self.reconnect_timer.cancel()
+            self.reconnect_timer = None
+        self.reconnect_delay = None
+        self.health.reset()
+        self.replay_filter.clear()
+
+        from .kernel import JupyterVimApp
+        self.ip_app = JupyterVimApp()
+        self.ip_app.kernel_pool = self.kernel_pool
+        self.ip_app.health = self.health
+        # the default is per process, and other sessions might be using it
+        self.ip_app.connection_file = self.ip_app._new_connection_file()
 
         # messages will be recieved in Jupyter's event loop threads
-        # so use the async self
-        self.ip_app.initialize(Async(self), argv)
+        # so use the dispatcher
+        self.ip_app.initialize(self.dispatcher, argv)
         self.ip_app.start()
         self.kc = self.ip_app.kernel_client
         self.km = self.ip_app.kernel_manager
         self.has_connection = True
+        self.exec_queue.reset()
+        self.executed.clear()
+        self.drop_input()
+        self.on_idle.clear()
+        self.idle_done.clear()
+        # execution counts start over with a new kernel
+        self.outputs.close()
 
-        reply = self.waitfor(self.kc.kernel_info())
+        try:
+            reply = self.waitfor(self.kc.kernel_info())
+        except RequestTimeout:
+            self.append_outbuf("nvim-ipy: no reply to kernel_info from the kernel\n",
+                               [["WarningMsg", 0, 0, -1]])
+            return
         c = reply['content']
 
         lang = c['language_info'].get('name', 'unknown')
@@ -251,7 +521,7 @@ class IPythonPlugin(object):
         try:
             ipy_version = c['ipython_version']
         except KeyError:
-            ipy_version = version_info
+            from jupyter_core import version_info as ipy_version
         vdesc = '.'.join(str(i) for i in ipy_version[:3])
         if len(ipy_version) >= 4 and ipy_version[3] != '':
             vdesc += '-' + ipy_version[3]
@@ -287,21 +557,61 @@ class IPythonPlugin(object):
             vim.current.window = w0
 
     def disp_status(self, status):
+        # the global variable shows the last kernel with activity
         self.vim.vars['ipy_status'] = status
+        if self.buf is not None:
+            self.buf.vars['ipy_status'] = status
+
+    def disp_queue(self, depth):
+        if depth != self.queue_depth:
+            self.queue_depth = depth
+            self.vim.vars['ipy_queue'] = depth
+            if self.buf is not None:
+                self.buf.vars['ipy_queue'] = depth
 
-    def handle(self, msg_id, handler):
-        self.pending_shell_msgs[msg_id] = handler
+    def handle(self, msg_id, handler, timeout=None):
+        self.pending_shell_msgs.add(msg_id, handler, timeout)
+        self.schedule_sweep()
 
-    def waitfor(self, msg_id, retval=None):
-        #FIXME: add some kind of timeout
+    def waitfor(self, msg_id, retval=None, timeout=None):
+        """Wait for the shell reply to msg_id and return it.
+
+        Raises RequestTimeout if there is no reply within timeout seconds
+        (default g:ipy_timeout).
+        """
         gr = greenlet.getcurrent()
-        self.handle(msg_id, gr)
+        self.handle(msg_id, gr, timeout)
         return gr.parent.switch(retval)
 
     def ignore(self, msg_id):
         self.handle(msg_id, None)
 
-    @neovim.function("IPyConnect", sync=True)
+    def schedule_sweep(self):
+        deadline = self.pending_shell_msgs.next_deadline()
+        if deadline is None:
+            return
+        if self.sweep_timer is not None:
+            if self.sweep_at <= deadline:
+                return
+            self.sweep_timer.cancel()
+        self.sweep_at = deadline
+        self.sweep_timer = self.vim.loop.call_later(
+            max(deadline - time.time(), 0), self.vim.async_call, self.sweep_requests)
+
+    def sweep_requests(self, now=None):
+        self.sweep_timer = None
+        for msg_id, handler in self.pending_shell_msgs.expire(now):
+            warn('no reply to shell request %s', msg_id)
+            if isinstance(handler, greenlet.greenlet):
+                handler.parent = greenlet.getcurrent()
+                try:
+                    handler.throw(RequestTimeout('no reply from kernel'))
+                except Exception:
+                    # a waiter which doesn't handle the timeout must not
+                    # stop the others from being woken
+                    error("Error after timeout of %s: %s", msg_id, format_exc())
+        self.schedule_sweep()
+
     def ipy_connect(self, args):
         self.configure()
 
@@ -316,21 +626,133 @@ class IPythonPlugin(object):
         # 'connect' waits for kernelinfo, and so must be async
         Async(self).connect(args)
 
-    @neovim.function("IPyRun")
     def ipy_run(self, args):
         code = args[0]
         silent = bool(args[1]) if len(args) > 1 else False
+        if self.check_dead():
+            return
+
+        self.exec_queue.submit(code, silent)
+
+    def check_dead(self):
+        """If the kernel died, offer to restart it and return True."""
         if self.km and not self.km.is_alive():
             choice = int(self.vim.funcs.confirm('Kernel died. Restart?', '&Yes\n&No'))
             if choice == 1:
-                if self.km.has_kernel:
+                km = self.kernel_pool.get(self.km.kernel_name) if self.kernel_pool else None
+                self.executed.clear()
+                if km is not None:
+                    self.replace_kernel(km)
+                elif self.km.has_kernel:
                     self.km.restart_kernel(True)
                 else:
                     self.km.start_kernel(**self.km._launch_args)
+            return True
+        return False
+
+    def ipy_run_cells(self, args):
+        """Execute a list of cells {code, start} one by one, and report the
+        time of each."""
+        cells = args[0]
+        if not cells or self.check_dead():
             return
-
-        reply = self.waitfor(self.kc.execute(code,silent=silent))
+        stop = bool(self.vim.vars.get("ipy_stop_on_error", 1))
+        batch = {'total': len(cells), 'done': 0, 'start': time.time(), 'last': 0}
+        for i, cell in enumerate(cells):
+            ex = self.exec_queue.submit(cell['code'], stop_on_error=stop, unique=False)
+            ex.callbacks.append(partial(self.on_cell_reply, batch, ex, i, cell.get('start')))
+
+    def ipy_run_stale_cells(self, args):
+        """Execute the cells whose code didn't run successfully in this
+        kernel, and with downstream also all cells after the first of them."""
+        cells = args[0]
+        downstream = bool(args[1]) if len(args) > 1 else False
+        stale = []
+        for cell in cells:
+            if (stale and downstream) or code_hash(cell['code']) not in self.executed:
+                stale.append(cell)
+        if not stale:
+            self.vim.out_write("nvim-ipy: no stale cells\n")
+            return
+        self.ipy_run_cells([stale])
+
+    def on_cell_reply(self, batch, ex, i, line, reply):
+        now = reply.get('nvim_ipy_recv') or time.time()
+        # the kernel runs one cell at a time, so a cell starts when it was
+        # sent, or when the previous one finished
+        elapsed = now - max(ex.sent, batch['last'])
+        batch['last'] = now
+        batch['done'] += 1
+        status = reply['content']['status']
+        if status == 'aborted':
+            return
+        # the reply can come before the output of the cell
+        self.after_output(ex.msg_id, partial(self.write_cell_time, batch, ex, i, line,
+                                             status, elapsed, now, batch['done']))
+
+    def after_output(self, msg_id, callback):
+        """Call callback once all output of execution msg_id was written,
+        which is when its idle status is handled."""
+        if msg_id in self.idle_done:
+            callback()
+        else:
+            self.on_idle.setdefault(msg_id, []).append(callback)
+
+    def write_cell_time(self, batch, ex, i, line, status, elapsed, now, done):
+        desc = u'cell {}/{}'.format(i+1, batch['total'])
+        if line is not None:
+            desc += u', line {}'.format(line)
+        if status == 'ok':
+            self.append_outbuf(u'[{}: {:.2f}s]\n'.format(desc, elapsed),
+                               [['Comment', 0, 0, -1]])
+        else:
+            self.append_outbuf(u'[{}: {} after {:.2f}s]\n'.format(desc, status, elapsed),
+                               [['WarningMsg', 0, 0, -1]])
+        if (status != 'ok' and ex.stop_on_error) or done == batch['total']:
+            self.append_outbuf(u'[ran {} of {} cells in {:.2f}s]\n'.format(
+                done, batch['total'], now - batch['start']), [['Comment', 0, 0, -1]])
+
+    def replace_kernel(self, km):
+        """Continue with the kernel of km, instead of restarting the dead one."""
+        self.kc.stop_channels()
+        self.km.cleanup_resources()
+        self.ip_app.kernel_manager = km
+        self.ip_app.connection_file = km.connection_file
+        self.health.reset()
+        self.replay_filter.clear()
+        self.ip_app.init_kernel_client()
+        self.kc = self.ip_app.kernel_client
+        self.km = km
+        # nothing will reply to requests sent to the dead kernel
+        self.sweep_requests(FOREVER)
+        self.exec_queue.reset()
+        self.executed.clear()
+        self.drop_input()
+        self.on_idle.clear()
+        self.idle_done.clear()
+        self.completions.clear()
+        self.outputs.close()
+        self.append_outbuf("\nnvim-ipy: using a new kernel from the pool\n",
+                           [["Comment", 1, 0, -1]])
+
+    def send_execute(self, ex):
+        msg_id = self.kc.execute(ex.code, silent=ex.silent, stop_on_error=ex.stop_on_error)
+        ex.sent = time.time()
+        self.handle(msg_id, self.on_execute_reply, timeout=FOREVER)
+        return msg_id
+
+    def on_execute_reply(self, reply):
+        ex = self.exec_queue.done(reply['parent_header']['msg_id'])
         content = reply['content']
+        if content['status'] != 'ok' and (ex is None or ex.stop_on_error):
+            # like the kernel does with its own queue, don't run code after
+            # an error
+            self.exec_queue.cancel()
+        if ex is not None and ex.silent:
+            # the namespace might have changed without a new execution_count
+            self.completions.clear()
+        elif ex is not None and content['status'] == 'ok':
+            self.executed[code_hash(ex.code)] = content.get('execution_count')
         payload = content.get('payload',())
         for p in payload:
             if p.get("source") == "page":
@@ -339,145 +761,670 @@ class IPythonPlugin(object):
                     self.append_outbuf(p['text'])
                 else:
                     self.append_outbuf(p['data']['text/plain'])
+        if ex is not None:
+            for callback in ex.callbacks:
+                callback(reply)
+
+    def ipy_cancel_queued(self, args):
+        self.exec_queue.cancel()
 
-    @neovim.function("IPyDbgWrite", sync=True)
     def ipy_write(self, args):
         self.append_outbuf(args[0])
 
-    @neovim.function("IPyComplete")
+    def complete(self, prefix, line=None, timeout=None):
+        """Get (cursor_start, matches) for the text before the cursor."""
+        res = self.completions.lookup(prefix, self.execution_count)
+        if res is None:
+            count = self.execution_count
+            reply = self.waitfor(self.kc.complete(line or prefix, len(prefix)), timeout=timeout)
+            content = reply["content"]
+            res = content["cursor_start"], content["matches"]
+            self.completions.add(prefix, count, *res)
+        return res
+
     def ipy_complete(self,args):
-        line = self.vim.current.line
-        #FIXME: (upstream) this sometimes get wrong if
-        #completing just after entering insert mode:
-        #pos = self.vim.current.buffer.mark(".")[1]+1
-        pos = self.vim.funcs.col('.')-1
-
-        reply = self.waitfor(self.kc.complete(line, pos))
-        content = reply["content"]
-        #TODO: check if position is still valid
-        start = content["cursor_start"]+1
-        self.vim.funcs.complete(start, content['matches'])
+        if self.completion_active:
+            # don't flood a busy kernel, complete again for the latest
+            # position when the request in flight is answered
+            self.completion_again = True
+            return
+        self.completion_active = True
+        try:
+            while True:
+                self.completion_again = False
+                mode, prefix, line = self.vim.api.exec_lua(CURSOR_STATE_LUA, [])
+                if not mode.startswith('i'):
+                    return
+                cached = self.completions.lookup(prefix, self.execution_count)
+                if cached is None:
+                    # the cursor might have moved while waiting, check
+                    # again with the reply in the cache
+                    try:
+                        self.complete(prefix, line)
+                    except RequestTimeout:
+                        return
+                    continue
+                if self.completion_again:
+                    continue
+                start, matches = cached
+                col = len(prefix[:start].encode('utf-8'))+1
+                try:
+                    self.vim.funcs.complete(col, matches)
+                except NvimError:
+                    # left insert mode in the meantime
+                    pass
+                return
+        finally:
+            self.completion_active = False
 
-    @neovim.function("IPyOmniFunc", sync=True)
     def ipy_omnifunc(self,args):
         findstart, base = args
         if findstart:
             if not self.has_connection:
                 return False
-            line = self.vim.current.line
-            pos = self.vim.funcs.col('.')-1
-
-            reply = self.waitfor(self.kc.complete(line, pos))
-            content = reply["content"]
-            start = content["cursor_start"]
-            self._matches = content['matches']
-            return start
+            mode, prefix, line = self.vim.api.exec_lua(CURSOR_STATE_LUA, [])
+            try:
+                start, self._matches = self.complete(prefix, line, self.omnifunc_timeout)
+            except RequestTimeout:
+                return -3 # cancel silently
+            return len(prefix[:start].encode('utf-8'))
         else:
             return self._matches
 
-    @neovim.function("IPyObjInfo")
+    def ipy_expand(self, args):
+        ids = self.vim.api.exec_lua("return require'nvim_ipy.output'.marks_at_cursor(...)",
+                                    [self.buf])
+        for mark in ids:
+            if mark in self.truncated:
+                marker, hidden = self.pop_truncated(mark)
+                if hidden is None:
+                    self.vim.out_write("nvim-ipy: the output is not stored anymore\n")
+                    return
+                lines = ANSI_RE.sub('', hidden).split('\n')
+                if self.vim.api.exec_lua("return require'nvim_ipy.output'.replace_mark_line(...)",
+                                         [self.buf, mark, marker, lines]):
+                    return
+        self.vim.out_write("nvim-ipy: no truncated output on this line\n")
+
     def ipy_objinfo(self, args):
         word, level = args
         #TODO: send entire line
-        reply = self.waitfor(self.kc.inspect(word, None, level))
+        try:
+            reply = self.waitfor(self.kc.inspect(word, None, level))
+        except RequestTimeout:
+            self.vim.out_write("nvim-ipy: no reply from kernel when inspecting {}\n".format(word))
+            return
 
         c = reply['content']
         if c["status"] == "error":
-            l = self.append_outbuf("\nerror when inspecting {}: {}\n".format(word, c.get("ename", "")))
-            if self.do_highlight:
-                self.buf.add_highlight("Error", l+1, 0, -1)
+            hls = [["Error", 1, 0, -1]] if self.do_highlight else []
+            self.append_outbuf("\nerror when inspecting {}: {}\n".format(word, c.get("ename", "")), hls)
             if "traceback" in c:
                 self.append_outbuf('\n'.join(c['traceback'])+"\n")
 
         elif not c.get('found'):
-            l = self.append_outbuf("\nnot found: {}\n".format(word))
-            if self.do_highlight:
-                self.buf.add_highlight("WarningMsg", l+1, 0, -1)
+            hls = [["WarningMsg", 1, 0, -1]] if self.do_highlight else []
+            self.append_outbuf("\nnot found: {}\n".format(word), hls)
         else:
             self.append_outbuf("\n"+c['data']['text/plain']+"\n")
 
-    @neovim.function("IPyInterrupt")
+    def ipy_requests(self, args):
+        return self.pending_shell_msgs.stats()
+
+    def ipy_stats(self, args):
+        stats = {
+            'latency': self.stats.summary(),
+            'requests': self.pending_shell_msgs.stats(),
+            'queue': len(self.exec_queue),
+            'outputs': self.outputs.stats(),
+            'health': dict(self.health.summary(), dropped_msgs=self.replay_filter.dropped),
+        }
+        if args and args[0]:
+            # reset, used by the benchmarks
+            self.stats.clear()
+        return stats
+
+    def find_output(self, args):
+        """Key and MIME type of the output selected by args: [count [index [mime]]],
+        where index starts at 1. Defaults to the last output, and its most
+        preferred MIME type."""
+        count = int(args[0]) if len(args) > 0 and args[0] != '' else None
+        index = int(args[1]) - 1 if len(args) > 1 else -1
+        keys, key = self.outputs.find(count, index)
+        mimes = self.outputs.mimetypes(key)
+        if len(args) > 2:
+            mime = args[2] if args[2] in mimes else None
+        else:
+            mime = next((m for m in MIME_PREFERENCE if m in mimes), mimes[0] if mimes else None)
+        return key, mime
+
+    def ipy_outputs(self, args):
+        """List the stored outputs as [count, index, mimetypes]."""
+        res = []
+        for key in self.outputs.outputs:
+            keys, _ = self.outputs.find(key[0])
+            res.append([key[0], keys.index(key)+1, self.outputs.mimetypes(key)])
+        return res
+
+    def ipy_open_output(self, args):
+        key, mime = self.find_output(args)
+        if mime is None:
+            self.vim.out_write("nvim-ipy: no such output\n")
+            return
+        path = self.outputs.export_temp(key, mime)
+        viewer = self.output_viewer
+        if not isinstance(viewer, list):
+            viewer = [viewer]
+        self.vim.funcs.jobstart(viewer + [path], {'detach': True})
+
+    def ipy_export_output(self, args):
+        path = os.path.expanduser(args[0])
+        key, mime = self.find_output(args[1:])
+        if key is not None and len(args) < 4:
+            # pick the MIME type by the extension, if possible
+            ext = os.path.splitext(path)[1]
+            mime = next((m for m in self.outputs.mimetypes(key) if EXTENSIONS.get(m) == ext),
+                        mime)
+        if mime is None:
+            self.vim.out_write("nvim-ipy: no such output\n")
+            return
+        self.outputs.export(key, mime, path)
+        self.vim.out_write("nvim-ipy: wrote {} to {}\n".format(mime, path))
+
     def ipy_interrupt(self, args):
+        self.exec_queue.cancel()
         self.km.interrupt_kernel()
 
-    @neovim.function("IPyTerminate")
     def ipy_terminate(self, args):
         self.km.shutdown_kernel()
 
+    def on_iopub_msg(self, m):
+        if m is not None:
+            if not self.replay_filter.accept(m):
+                return
+            self.stats.since('iopub_dispatch', m.get('nvim_ipy_recv'))
+            m['nvim_ipy_queued'] = time.time()
+        self.iopub_handler(m)
+
     def _on_iopub_msg(self, m):
         #FIXME: figure out the smoothest way to to matchaddpos
         # (from a different window), or just use concealends
         try:
+            if m is None:
+                # stream flush timer
+                self.stream_timer = None
+                self.flush_stream(throttle=True)
+                return
             t = m['header'].get('msg_type',None)
             c = m['content']
 
             debug('iopub %s: %r', t, c)
+            self.stats.since('iopub_queue', m.get('nvim_ipy_queued'))
+            recv = m.get('nvim_ipy_recv')
+            if t == 'stream':
+                #perhaps distinguish stderr using gutter marks?
+                self.write_stream(c['text'], recv)
+                return
+            # pending stream output goes before anything else
+            self.flush_stream()
+
             if t == 'status':
                 status = c['execution_state']
                 self.disp_status(status)
+                if status == 'idle':
+                    parent_id = m['parent_header'].get('msg_id')
+                    self.drop_input(parent_id)
+                    self.end_execution(parent_id)
+                    self.idle_done.add(parent_id)
+                    for callback in self.on_idle.pop(parent_id, ()):
+                        callback()
             elif t in ['pyin', 'execute_input']:
+                self.execution_count = c['execution_count']
+                for count in self.fold_pending:
+                    if count in self.exec_marks:
+                        self.exec_call('exec_fold', count)
+                self.fold_pending = []
                 prompt = self.prompt_in.format(c['execution_count'])
                 code = c['code'].rstrip().split('\n')
-                if self.max_in and len(code) > self.max_in:
-                    code = code[:self.max_in] + ['.....']
                 sep = '\n'+' '*len(prompt)
-                line = self.append_outbuf(u'\n{}{}\n'.format(prompt, sep.join(code)))
-                self.buf.add_highlight('IPyIn', line+1, 0, len(prompt))
+                hls = [['IPyIn', 1, 0, len(prompt)]]
+                # mark the In[] line as the start of the execution
+                marks = [[1]]
+                if self.max_in and len(code) > self.max_in:
+                    text = u'\n{}{}\n'.format(prompt, sep.join(code[:self.max_in]))
+                    hidden = ' '*len(prompt) + sep.join(code[self.max_in:])
+                    ids = self.append_truncated(text, hidden, hls, marks)
+                else:
+                    text = u'\n{}{}\n'.format(prompt, sep.join(code))
+                    lineidx, ids = self.append_outbuf_marked(text, marks, hls)
+                self.start_execution(c['execution_count'], m['parent_header'].get('msg_id'),
+                                     ids[0])
             elif t in ['pyout', 'execute_result']:
                 no = c['execution_count']
+                key = self.outputs.add(no, m['header']['msg_id'], c['data'])
                 res = c['data'].get('text/plain')
                 if res is None:
-                    # TODO: still print a marker for unprintable output?
+                    self.append_output_hint(key)
                     return
                 prompt = self.prompt_out.format(no)
                 if '\n' in res and not prompt.endswith("\n"):
                     prompt = prompt.rstrip() + "\n"
-                line = self.append_outbuf((u'{}{}\n').format(prompt, res))
-                self.buf.add_highlight('IPyOut', line, 0, len(prompt))
+                hls = [['IPyOut', 0, 0, len(prompt)]]
+                full = res
+                res, hidden = self.truncate_output(res)
+                if hidden is not None:
+                    self.append_truncated((u'{}{}\n').format(prompt, res), hidden, hls,
+                                          source=(key, len(full) - len(hidden)))
+                else:
+                    self.append_outbuf((u'{}{}\n').format(prompt, res), hls)
+                self.append_output_hint(key)
             elif t in ['pyerr', 'error']:
                 #TODO: this should be made language specific
                 # as the amt of info in 'traceback' differs
                 self.append_outbuf('\n'.join(c['traceback']) + '\n')
-            elif t == 'stream':
-                #perhaps distinguish stderr using gutter marks?
-                self.append_outbuf(c['text'])
             elif t == 'display_data':
-                d = c['data']['text/plain']
-                self.append_outbuf(d + '\n')
+                key = self.outputs.add(self.execution_count, m['header']['msg_id'], c['data'])
+                if 'text/plain' in c['data']:
+                    full = c['data']['text/plain']
+                    d, hidden = self.truncate_output(full)
+                    if hidden is not None:
+                        self.append_truncated(d + '\n', hidden,
+                                              source=(key, len(full) - len(hidden)))
+                    else:
+                        self.append_outbuf(d + '\n')
+                self.append_output_hint(key)
+            else:
+                return
+            self.stats.since('output_latency', recv)
         except Exception as e:
             debug("Couldn't handle iopub message %r: %s", m, format_exc())
 
 
+    def append_output_hint(self, key):
+        """Show how to open a stored output which has more than plain text."""
+        mimes = [mime for mime in self.outputs.mimetypes(key) if mime != 'text/plain']
+        if mimes:
+            keys, _ = self.outputs.find(key[0])
+            self.append_outbuf(u'[{}: :IPyOpenOutput {} {}]\n'.format(
+                ', '.join(mimes), key[0], keys.index(key)+1), [['Comment', 0, 0, -1]])
+
+    def start_execution(self, count, msg_id, mark):
+        old = self.exec_marks.pop(count, None)
+        if old is not None:
+            # the kernel was restarted
+            for old_mark in old:
+                self.exec_by_mark.pop(old_mark, None)
+        self.exec_marks[count] = [mark, None]
+        self.exec_by_msg[msg_id] = count
+        self.exec_by_mark[mark] = count
+
+    def end_execution(self, msg_id):
+        count = self.exec_by_msg.pop(msg_id, None)
+        if count not in self.exec_marks:
+            return
+        mark = self.vim.api.exec_lua("return require'nvim_ipy.output'.mark_end(...)", [self.buf])
+        self.exec_marks[count][1] = mark
+        self.exec_by_mark[mark] = count
+        if self.fold_finished:
+            # folded when the next execution starts, to still show the output
+            self.fold_pending.append(count)
+
+    def exec_call(self, func, count, *args):
+        """Call a function of output.lua for the output of execution count."""
+        start, end = self.exec_marks[count]
+        return self.vim.api.exec_lua("return require'nvim_ipy.output'.{}(...)".format(func),
+                                     [self.buf, start, end] + list(args))
+
+    def find_execution(self, args):
+        """Execution count given by args[0], or else the one at the cursor in the
+        output buffer, or else the last one. None if there is none."""
+        if args and args[0] != '':
+            count = int(args[0])
+            return count if count in self.exec_marks else None
+        mark = self.vim.api.exec_lua("return require'nvim_ipy.output'.exec_at_cursor(...)",
+                                     [self.buf])
+        if mark is not None and mark in self.exec_by_mark:
+            return self.exec_by_mark[mark]
+        return next(reversed(self.exec_marks), None)
+
+    def ipy_jump(self, args):
+        count = self.find_execution(args)
+        if count is None or not self.exec_call('exec_jump', count):
+            self.vim.out_write("nvim-ipy: no such execution\n")
+
+    def ipy_fold(self, args):
+        count = self.find_execution(args)
+        if count is not None:
+            self.exec_call('exec_fold', count)
+
+    def ipy_clear(self, args):
+        count = self.find_execution(args)
+        if count is None:
+            return
+        self.exec_call('exec_clear', count)
+        for mark in self.exec_marks.pop(count):
+            self.exec_by_mark.pop(mark, None)
+
+    def ipy_copy(self, args):
+        count = self.find_execution(args)
+        if count is None:
+            return
+        register = args[1] if len(args) > 1 else '"'
+        lines = self.exec_call('exec_lines', count)
+        self.vim.funcs.setreg(register, lines, 'l')
+
     def on_shell_msg(self, m):
         self.last_msg = m
         debug('shell %s: %r', m['msg_type'], m['content'])
         msg_id = m['parent_header']['msg_id']
+        recv = m.get('nvim_ipy_recv')
+        self.stats.since('shell_dispatch', recv)
         try:
-            handler = self.pending_shell_msgs.pop(msg_id)
+            handler, sent = self.pending_shell_msgs.pop(msg_id)
         except KeyError:
             debug('unexpected shell msg: %r', m)
             return
+        if recv is not None:
+            self.stats.record('shell_roundtrip', recv - sent)
         if isinstance(handler, greenlet.greenlet):
             handler.parent = greenlet.getcurrent()
             handler.switch(m)
         elif handler is not None:
             handler(m)
 
-    #this gets called when heartbeat is lost
-    def on_hb_msg(self, time_since):
-        self.disp_status("DEAD")
+    # called from the heartbeat thread when the health should be shown again
+    def on_health(self):
+        health = self.health
+        if health.state == 'unresponsive':
+            if self.km is not None and self.km.has_kernel and not self.km.is_alive():
+                # our kernel process is gone, reconnecting won't help
+                health.set_state('dead')
+                self.disp_status("DEAD")
+            elif (self.auto_reconnect and health.failures >= self.reconnect_after
+                  and self.reconnect_timer is None):
+                self.schedule_reconnect()
+        elif health.state == 'alive' and self.reconnect_delay is not None:
+            if self.reconnect_timer is not None:
+                self.reconnect_timer.cancel()
+                self.reconnect_timer = None
+            self.reconnect_delay = None
+            self.append_outbuf("nvim-ipy: kernel is responding again\n", [["Comment", 0, 0, -1]])
+        self.disp_health()
+
+    def disp_health(self):
+        # like ipy_status, the global variable shows the last kernel with news
+        health = self.health.summary()
+        self.vim.vars['ipy_health'] = health
+        if self.buf is not None:
+            self.buf.vars['ipy_health'] = health
+
+    def schedule_reconnect(self):
+        """Try new channels after a delay, which doubles with every attempt
+        until the kernel answers."""
+        if self.reconnect_delay is None:
+            self.reconnect_delay = 1
+        else:
+            self.reconnect_delay = min(2 * self.reconnect_delay, MAX_RECONNECT_DELAY)
+        self.health.reconnecting()
+        self.reconnect_timer = self.vim.loop.call_later(
+            self.reconnect_delay, self.vim.async_call, self.reconnect)
+
+    def reconnect(self):
+        """Connect new channels to the same kernel, keeping the session and
+        its output buffer."""
+        self.reconnect_timer = None
+        if not self.has_connection or self.health.state != 'reconnecting':
+            return
+        try:
+            self.kc.stop_channels()
+            self.ip_app.init_kernel_client()
+            self.kc = self.ip_app.kernel_client
+            lost = self.exec_queue.lost()
+            if lost:
+                self.append_outbuf("nvim-ipy: reconnecting, lost the reply to {} execution(s)\n"
+                                   .format(len(lost)), [["Comment", 0, 0, -1]])
+            # replies to requests sent on the old channels won't arrive
+            self.sweep_requests(FOREVER)
+        finally:
+            # further missed beats schedule the next attempt
+            self.health.set_state('unresponsive')
 
     def on_stdin_msg(self, msg):
-        self.last_msg = msg
+        # answered in order, output keeps coming in meanwhile
+        self.input_requests.append(msg)
+        if len(self.input_requests) == 1:
+            self.show_input()
+
+    def show_input(self):
+        msg = self.input_requests[0]
+        c = msg["content"]
+        if self.input_mode == "float" and not c.get("password"):
+            self.vim.api.exec_lua("require'nvim_ipy.input'.open(...)",
+                                  [self.buf, self.name, c["prompt"]])
+            return
+
+        func = self.vim.funcs.inputsecret if c.get("password") else self.vim.funcs.input
         try:
-            res = self.vim.funcs.input("(IPy) " + msg["content"]["prompt"])
+            res = func("(IPy) " + c["prompt"])
         except NvimError:
             #TODO(nvim) return exceptions precisely
             # for now assume keyboard interrupt
             self.ipy_interrupt([])
             return
 
-        if self.last_msg is msg:
-            # from jupyter_console, input should be considered to be interrupted
-            # if there was another message
-            self.kc.input(res)
+        if self.input_requests and self.input_requests[0] is msg:
+            # the request was dropped if the execution was interrupted
+            # meanwhile
+            self.ipy_input_reply([res])
+
+    def ipy_input_reply(self, args):
+        if not self.input_requests:
+            return
+        msg = self.input_requests.popleft()
+        c = msg["content"]
+        # show the answer like a terminal would, after the output before it
+        self.flush_stream()
+        self.append_outbuf(c["prompt"] + ("" if c.get("password") else args[0]) + "\n")
+        self.kc.input(args[0])
+        if self.input_requests:
+            self.show_input()
+
+    def drop_input(self, parent_id=None):
+        """Forget the input requests of an execution which is over (all
+        of them by default), and close the prompt if it was for one."""
+        if not self.input_requests:
+            return
+        head = self.input_requests[0]
+        self.input_requests = deque(m for m in self.input_requests
+                                    if parent_id is not None and
+                                    m["parent_header"].get("msg_id") != parent_id)
+        if self.input_requests and self.input_requests[0] is head:
+            return
+        self.vim.api.exec_lua("require'nvim_ipy.input'.close(...)", [self.name])
+        if self.input_requests:
+            self.show_input()
+
+
+@neovim.plugin
+@neovim.encoding(True)
+class IPythonPlugin(object):
+    """Routes the functions to a kernel session.
+
+    A source buffer uses the session named by b:ipy_kernel, otherwise the
+    last connected one. Output buffers have b:ipy_kernel set to their session.
+    """
+    def __init__(self, vim):
+        self.vim = vim
+        self.sessions = OrderedDict()
+        self.kernel_pool = None
+
+    def configure_pool(self):
+        if self.kernel_pool is None:
+            from .kernel import KernelPool
+            self.kernel_pool = KernelPool()
+        self.kernel_pool.configure(self.vim.vars.get("ipy_kernel_pool", 0),
+                                   self.vim.vars.get("ipy_kernel_pool_spec", ""),
+                                   self.vim.vars.get("ipy_kernel_pool_preload", ""))
+
+    def session(self, quiet=False):
+        if not self.sessions:
+            if not quiet:
+                self.vim.out_write("nvim-ipy: not connected to a kernel\n")
+            return None
+        name = self.vim.eval("get(b:, 'ipy_kernel', '')")
+        if not name:
+            return next(reversed(self.sessions.values()))
+        session = self.sessions.get(name)
+        if session is None and not quiet:
+            self.vim.out_write("nvim-ipy: no kernel named {}\n".format(name))
+        return session
+
+    @neovim.function("IPyConnect", sync=True)
+    def ipy_connect(self, args):
+        name = DEFAULT_KERNEL
+        if '--name' in args:
+            i = args.index('--name')
+            name = args[i+1]
+            del args[i:i+2]
+        self.configure_pool()
+        session = self.sessions.pop(name, None)
+        if session is None:
+            session = KernelSession(self.vim, name, self.kernel_pool)
+        # the last connected session is the default
+        self.sessions[name] = session
+        session.ipy_connect(args)
+
+    @neovim.function("IPyKernelPool", sync=True)
+    def ipy_kernel_pool(self, args):
+        """Start filling the pool now, and return its state."""
+        self.configure_pool()
+        return self.kernel_pool.stats()
+
+    @neovim.function("IPyKernels", sync=True)
+    def ipy_kernels(self, args):
+        return list(self.sessions)
+
+    @neovim.function("IPyRun")
+    def ipy_run(self, args):
+        session = self.session()
+        if session is not None:
+            session.ipy_run(args)
+
+    @neovim.function("IPyRunCells")
+    def ipy_run_cells(self, args):
+        session = self.session()
+        if session is not None:
+            session.ipy_run_cells(args)
+
+    @neovim.function("IPyRunStaleCells")
+    def ipy_run_stale_cells(self, args):
+        session = self.session()
+        if session is not None:
+            session.ipy_run_stale_cells(args)
+
+    @neovim.function("IPyCancelQueued")
+    def ipy_cancel_queued(self, args):
+        session = self.session()
+        if session is not None:
+            session.ipy_cancel_queued(args)
+
+    @neovim.function("IPyDbgWrite", sync=True)
+    def ipy_write(self, args):
+        session = self.session()
+        if session is not None:
+            session.ipy_write(args)
+
+    @neovim.function("IPyComplete")
+    def ipy_complete(self, args):
+        session = self.session(quiet=True)
+        if session is not None:
+            session.ipy_complete(args)
+
+    @neovim.function("IPyOmniFunc", sync=True)
+    def ipy_omnifunc(self, args):
+        session = self.session(quiet=True)
+        if session is None:
+            return False if args[0] else []
+        return session.ipy_omnifunc(args)
+
+    @neovim.function("IPyExpand")
+    def ipy_expand(self, args):
+        session = self.session()
+        if session is not None:
+            session.ipy_expand(args)
+
+    @neovim.function("IPyJump")
+    def ipy_jump(self, args):
+        session = self.session()
+        if session is not None:
+            session.ipy_jump(args)
+
+    @neovim.function("IPyFold")
+    def ipy_fold(self, args):
+        session = self.session()
+        if session is not None:
+            session.ipy_fold(args)
+
+    @neovim.function("IPyClear")
+    def ipy_clear(self, args):
+        session = self.session()
+        if session is not None:
+            session.ipy_clear(args)
+
+    @neovim.function("IPyCopy")
+    def ipy_copy(self, args):
+        session = self.session()
+        if session is not None:
+            session.ipy_copy(args)
+
+    @neovim.function("IPyObjInfo")
+    def ipy_objinfo(self, args):
+        session = self.session()
+        if session is not None:
+            session.ipy_objinfo(args)
+
+    @neovim.function("IPyRequests", sync=True)
+    def ipy_requests(self, args):
+        session = self.session(quiet=True)
+        return session.ipy_requests(args) if session is not None else {}
+
+    @neovim.function("IPyStats", sync=True)
+    def ipy_stats(self, args):
+        session = self.session(quiet=True)
+        return session.ipy_stats(args) if session is not None else {}
+
+    @neovim.function("IPyOutputs", sync=True)
+    def ipy_outputs(self, args):
+        session = self.session(quiet=True)
+        return session.ipy_outputs(args) if session is not None else []
+
+    @neovim.function("IPyOpenOutput")
+    def ipy_open_output(self, args):
+        session = self.session()
+        if session is not None:
+            session.ipy_open_output(args)
+
+    @neovim.function("IPyExportOutput")
+    def ipy_export_output(self, args):
+        session = self.session()
+        if session is not None:
+            session.ipy_export_output(args)
+
+    @neovim.function("IPyInputReply")
+    def ipy_input_reply(self, args):
+        # the prompt is closed by the time this runs, so it names its kernel
+        session = self.sessions.get(args[1]) if len(args) > 1 else self.session()
+        if session is not None:
+            session.ipy_input_reply(args)
+
+    @neovim.function("IPyInterrupt")
+    def ipy_interrupt(self, args):
+        session = self.session()
+        if session is not None:
+            session.ipy_interrupt(args)
+
+    @neovim.function("IPyTerminate")
+    def ipy_terminate(self, args):
+        session = self.session()
+        if session is not None:
+            session.ipy_terminate(args)
@@ -45,6 +45,94 @@ ANSI_PATTERN = ('\x01?\x1b(%s|%s)\x02?' % \
                 (CSI_SUBPATTERN, OSC_SUBPATTERN))
 ANSI_OR_SPECIAL_PATTERN = re.compile('(\a|\b|\r(?!\n)|\r?\n)|(?:%s)' % ANSI_PATTERN)
 SPECIAL_PATTERN = re.compile('([\f])')
+ANSI_RE = re.compile(ANSI_PATTERN)
+
+# SGR codes which just set one attribute.
+SGR_ATTRIBUTES = {
+    3: ('italic', True),
+    4: ('underline', True),
+    23: ('italic', False),
+    24: ('underline', False),
+    39: ('foreground_color', None),
+    49: ('background_color', None),
+}
+for _i in range(8):
+    SGR_ATTRIBUTES[30 + _i] = ('foreground_color', _i)
+    SGR_ATTRIBUTES[40 + _i] = ('background_color', _i)
+    # aixterm bright colors
+    SGR_ATTRIBUTES[90 + _i] = ('foreground_color', 8 + _i)
+    SGR_ATTRIBUTES[100 + _i] = ('background_color', 8 + _i)
+del _i
+
+SGR_RESET = (('intensity', 0), ('italic', False), ('bold', False),
+             ('underline', False), ('foreground_color', None),
+             ('background_color', None))
+
+# Compiled SGR sequences, as they tend to repeat a lot in colored output.
+SGR_CACHE_SIZE = 1024
+_sgr_cache = {}
+
+def _compile_sgr(params, bold_text_enabled):
+    """ Translate a list of SGR codes to a list of (attribute, value) pairs.
+    """
+    ops = []
+    i = 0
+    while i < len(params):
+        code = params[i]
+        i += 1
+        if code in SGR_ATTRIBUTES:
+            ops.append(SGR_ATTRIBUTES[code])
+        elif code == 0:
+            ops.extend(SGR_RESET)
+        elif code == 1:
+            if bold_text_enabled:
+                ops.append(('bold', True))
+            else:
+                ops.append(('intensity', 1))
+        elif code == 2:
+            ops.append(('intensity', 0))
+        elif code == 22:
+            ops.extend((('intensity', 0), ('bold', False)))
+        elif code == 38 or code == 48:
+            name = 'foreground_color' if code == 38 else 'background_color'
+            mode = params[i] if i < len(params) else None
+            i += 1
+            if mode == 5:
+                # xterm-specific: 256 color support.
+                if i < len(params):
+                    ops.append((name, params[i]))
+                i += 1
+            elif mode == 2:
+                # truecolor, as an (r, g, b) tuple
+                if i + 2 < len(params):
+                    ops.append((name, tuple(min(c, 255) for c in params[i:i+3])))
+                i += 3
+    return tuple(ops)
+
+#-----------------------------------------------------------------------------
+# Functions
+#-----------------------------------------------------------------------------
+
+def collapse_carriage_returns(string):
+    """ Drop text which is overwritten by a later carriage return on the same
+        line, as progress bars do all the time. Escape codes in the dropped
+        text are kept, so the resulting graphics state is the same.
+    """
+    if '\r' not in string:
+        return string
+    lines = string.split('\n')
+    for i, line in enumerate(lines):
+        # a '\r' as last character is either part of '\r\n' or clears
+        # the line, so it is kept as is
+        cr = line.rfind('\r', 0, len(line) - 1)
+        if cr <= 0:
+            continue
+        dropped = line[:cr]
+        codes = ''
+        if '\x1b' in dropped:
+            codes = ''.join(m.group(0) for m in ANSI_RE.finditer(dropped))
+        lines[i] = codes + line[cr:]
+    return '\n'.join(lines)
 
 #-----------------------------------------------------------------------------
 # Classes
@@ -82,6 +170,19 @@ class AnsiCodeProcessor(object):
         self.foreground_color = None
         self.background_color = None
 
+    def split_lines(self, string):
+        """ Fast path of split_string for text without escape codes or
+            special characters, which is most output.
+
+            Returns the list of lines in the string, or None if split_string
+            must be used instead.
+        """
+        if ('\x1b' in string or '\r' in string or '\b' in string or
+                '\a' in string or '\f' in string):
+            return None
+        self.actions = []
+        return string.split('\n')
+
     def split_string(self, string):
         """ Yields substrings for which the same escape code applies.
         """
@@ -95,8 +196,9 @@ class AnsiCodeProcessor(object):
         string = string[:-1] if last_char is not None else string
 
         for match in ANSI_OR_SPECIAL_PATTERN.finditer(string):
-            raw = string[start:match.start()]
-            substring = SPECIAL_PATTERN.sub(self._replace_special, raw)
+            substring = string[start:match.start()]
+            if '\f' in substring:
+                substring = SPECIAL_PATTERN.sub(self._replace_special, substring)
             if substring or self.actions:
                 yield substring
                 self.actions = []
@@ -136,8 +238,9 @@ class AnsiCodeProcessor(object):
                     # Case 2: OSC code.
                     self.set_osc_code(params)
 
-        raw = string[start:]
-        substring = SPECIAL_PATTERN.sub(self._replace_special, raw)
+        substring = string[start:]
+        if '\f' in substring:
+            substring = SPECIAL_PATTERN.sub(self._replace_special, substring)
         if substring or self.actions:
             yield substring
             self.actions = []
@@ -215,50 +318,14 @@ class AnsiCodeProcessor(object):
             sequence will have one element per command, although certain
             xterm-specific commands requires multiple elements.
         """
-        # Always consume the first parameter.
-        if not params:
-            return
-        code = params.pop(0)
-
-        if code == 0:
-            self.reset_sgr()
-        elif code == 1:
-            if self.bold_text_enabled:
-                self.bold = True
-            else:
-                self.intensity = 1
-        elif code == 2:
-            self.intensity = 0
-        elif code == 3:
-            self.italic = True
-        elif code == 4:
-            self.underline = True
-        elif code == 22:
-            self.intensity = 0
-            self.bold = False
-        elif code == 23:
-            self.italic = False
-        elif code == 24:
-            self.underline = False
-        elif code >= 30 and code <= 37:
-            self.foreground_color = code - 30
-        elif code == 38 and params and params.pop(0) == 5:
-            # xterm-specific: 256 color support.
-            if params:
-                self.foreground_color = params.pop(0)
-        elif code == 39:
-            self.foreground_color = None
-        elif code >= 40 and code <= 47:
-            self.background_color = code - 40
-        elif code == 48 and params and params.pop(0) == 5:
-            # xterm-specific: 256 color support.
-            if params:
-                self.background_color = params.pop(0)
-        elif code == 49:
-            self.background_color = None
-
-        # Recurse with unconsumed parameters.
-        self.set_sgr_code(params)
+        key = (tuple(params), self.bold_text_enabled)
+        ops = _sgr_cache.get(key)
+        if ops is None:
+            if len(_sgr_cache) >= SGR_CACHE_SIZE:
+                _sgr_cache.clear()
+            ops = _sgr_cache[key] = _compile_sgr(params, self.bold_text_enabled)
+        for name, value in ops:
+            setattr(self, name, value)
 
     #---------------------------------------------------------------------------
     # Protected interface
@@ -0,0 +1,83 @@
+"""Client side queue of code waiting to be executed."""
+from collections import deque
+
+class Execution(object):
+    """Code submitted for execution, and callbacks for its reply."""
+    def __init__(self, code, silent=False, stop_on_error=True):
+        self.code = code
+        self.silent = silent
+        self.stop_on_error = stop_on_error
+        self.callbacks = []
+        self.msg_id = None
+        self.sent = None
+
+class ExecutionQueue(object):
+    """Pipelines execute requests to the kernel with backpressure.
+
+    At most max_inflight requests are sent to the kernel without having been
+    replied to. The rest wait in the queue, where they can still be
+    cancelled, and where submitting the same code again is a no-op (unless
+    unique is false, as when running all cells of a file).
+
+    send(execution) must send the request and return its msg_id, and the
+    owner must call done(msg_id) when the reply arrives. on_change() is
+    called when the depth of the queue changes.
+    """
+    def __init__(self, send, max_inflight=4, on_change=None):
+        self.send = send
+        self.max_inflight = max_inflight
+        self.on_change = on_change
+        self.queue = deque()
+        self.inflight = {}
+
+    def __len__(self):
+        return len(self.queue) + len(self.inflight)
+
+    def submit(self, code, silent=False, callback=None, stop_on_error=True, unique=True):
+        for ex in self.queue if unique else ():
+            if ex.code == code and ex.silent == silent:
+                break
+        else:
+            ex = Execution(code, silent, stop_on_error)
+            self.queue.append(ex)
+        if callback is not None:
+            ex.callbacks.append(callback)
+        self.pump()
+        return ex
+
+    def pump(self):
+        while self.queue and len(self.inflight) < self.max_inflight:
+            ex = self.queue.popleft()
+            ex.msg_id = self.send(ex)
+            self.inflight[ex.msg_id] = ex
+        self.changed()
+
+    def done(self, msg_id):
+        """Mark the request as replied, and return its Execution (or None)."""
+        ex = self.inflight.pop(msg_id, None)
+        self.pump()
+        return ex
+
+    def cancel(self):
+        """Drop all executions not yet sent, and return them."""
+        cancelled = list(self.queue)
+        self.queue.clear()
+        self.changed()
+        return cancelled
+
+    def lost(self):
+        """Forget the requests sent, when their replies can't arrive anymore,
+        and send the queued ones instead. Returns the lost executions."""
+        lost = list(self.inflight.values())
+        self.inflight.clear()
+        self.pump()
+        return lost
+
+    def reset(self):
+        """Forget everything, when connecting to a new kernel."""
+        self.inflight.clear()
+        self.cancel()
+
+    def changed(self):
+        if self.on_change is not None:
+            self.on_change(len(self))
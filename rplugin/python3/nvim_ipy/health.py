@@ -0,0 +1,130 @@
+"""Liveness of the kernel connection, and filtering of replayed messages."""
+from collections import deque
+import threading
+import time
+
+from .stats import Histogram
+
+class HealthMonitor(object):
+    """State of a kernel connection, as seen by the heartbeat channel.
+
+    beat() and failed() are called from the heartbeat thread, and return
+    True when the state shown to the user should be updated: when it
+    changed, on every missed beat until the kernel is dead, and otherwise
+    at most every update_interval seconds.
+
+    The states are 'connecting', 'alive', 'unresponsive' (missed beats),
+    'reconnecting' (new channels are being tried) and 'dead' (the kernel
+    process we started is gone).
+    """
+    def __init__(self, update_interval=5, size=120):
+        self.update_interval = update_interval
+        self.lock = threading.Lock()
+        self.latency = Histogram(size)
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.state = 'connecting'
+            self.last_latency = None
+            # consecutive missed beats
+            self.failures = 0
+            self.reconnects = 0
+            self.last_update = 0
+
+    def beat(self, seconds):
+        with self.lock:
+            self.latency.add(seconds)
+            self.last_latency = seconds
+            self.failures = 0
+            return self._set('alive')
+
+    def failed(self):
+        with self.lock:
+            self.failures += 1
+            if self.state not in ('reconnecting', 'dead'):
+                self._set('unresponsive')
+            return self.state != 'dead'
+
+    def reconnecting(self):
+        with self.lock:
+            self.reconnects += 1
+            self._set('reconnecting')
+
+    def set_state(self, state):
+        with self.lock:
+            self._set(state)
+
+    def _set(self, state):
+        now = time.time()
+        changed = state != self.state
+        self.state = state
+        if changed or now - self.last_update >= self.update_interval:
+            self.last_update = now
+            return True
+        return False
+
+    def summary(self):
+        with self.lock:
+            latency = self.latency.summary()
+            return {
+                'state': self.state,
+                'latency_ms': None if self.last_latency is None else 1000 * self.last_latency,
+                'latency_p50_ms': latency.get('p50'),
+                'latency_p99_ms': latency.get('p99'),
+                'failures': self.failures,
+                'reconnects': self.reconnects,
+            }
+
+class RecentIds(object):
+    """Set of the last size ids added."""
+    def __init__(self, size):
+        self.order = deque()
+        self.ids = set()
+        self.size = size
+
+    def __contains__(self, key):
+        return key in self.ids
+
+    def add(self, key):
+        if key in self.ids:
+            return
+        self.order.append(key)
+        self.ids.add(key)
+        if len(self.order) > self.size:
+            self.ids.discard(self.order.popleft())
+
+    def clear(self):
+        self.order.clear()
+        self.ids.clear()
+
+class ReplayFilter(object):
+    """Drops iopub messages which were handled before, by msg_id, and the
+    status and execute_input messages of executions which already went
+    idle, which would otherwise show a finished execution as running.
+
+    Output of finished executions is kept, as background threads of the
+    kernel can legitimately print after their cell.
+    """
+    def __init__(self, size=1000):
+        self.seen = RecentIds(size)
+        self.finished = RecentIds(size)
+        self.dropped = 0
+
+    def accept(self, msg):
+        msg_type = msg['header'].get('msg_type')
+        msg_id = msg['header'].get('msg_id')
+        parent = msg['parent_header'].get('msg_id')
+        if (msg_id and msg_id in self.seen or
+                parent and parent in self.finished and msg_type in ('status', 'execute_input')):
+            self.dropped += 1
+            return False
+        if msg_id:
+            self.seen.add(msg_id)
+        if msg_type == 'status' and parent and msg['content'].get('execution_state') == 'idle':
+            self.finished.add(parent)
+        return True
+
+    def clear(self):
+        self.seen.clear()
+        self.finished.clear()
@@ -0,0 +1,109 @@
+"""Highlight groups for the graphics states of ANSI escape codes."""
+
+# gui colors of the IPyFg0..IPyFg15 groups in plugin/ipy.vim
+BASIC_COLORS = ["Black", "Red", "Green", "DarkYellow", "Blue", "DarkMagenta", "#00bbdd",
+                "LightGray", "Gray", "#ff4444", "LimeGreen", "Yellow", "LightBlue", "Magenta",
+                "Cyan", "White"]
+
+CUBE_LEVELS = [0, 95, 135, 175, 215, 255]
+
+def xterm_rgb(n):
+    """(r, g, b) of color n > 15 of the xterm 256 color palette."""
+    if n >= 232:
+        v = 8 + 10 * (n - 232)
+        return (v, v, v)
+    n -= 16
+    return (CUBE_LEVELS[n // 36], CUBE_LEVELS[n // 6 % 6], CUBE_LEVELS[n % 6])
+
+def nearest_xterm(rgb):
+    """The xterm 256 color palette index closest to rgb, for ctermfg."""
+    def dist(c):
+        return sum((a - b) ** 2 for a, b in zip(c, rgb))
+    cube = [min(range(6), key=lambda i: abs(CUBE_LEVELS[i] - v)) for v in rgb]
+    best = 16 + 36 * cube[0] + 6 * cube[1] + cube[2]
+    gray = min(max(int(round((sum(rgb) / 3 - 8) / 10)), 0), 23) + 232
+    return gray if dist(xterm_rgb(gray)) < dist(xterm_rgb(best)) else best
+
+def color_spec(color):
+    """(gui, cterm) colors for an ANSI color: a palette index or (r, g, b)."""
+    if isinstance(color, tuple):
+        return '#{:02x}{:02x}{:02x}'.format(*color), nearest_xterm(color)
+    if color < 16:
+        return BASIC_COLORS[color], color
+    return '#{:02x}{:02x}{:02x}'.format(*xterm_rgb(color)), color
+
+def color_name(color):
+    if isinstance(color, tuple):
+        return '{:02x}{:02x}{:02x}'.format(*color)
+    return str(color)
+
+def is_plain(fg, bg, bold, italic, underline):
+    """Whether the IPyFg{n} and IPyBold groups can show the state."""
+    return bg is None and not italic and not underline and (fg is None or fg in range(16))
+
+class HighlightRegistry(object):
+    """Highlight groups for each combination of attributes seen in output.
+
+    Plain 16 color states use the IPyFg{n} and IPyBold groups. Others get a
+    group defined on first use, which is queued in pending until the next
+    append sends the definitions to nvim. At most size such groups are
+    defined; after that other states fall back to the plain groups, and
+    the cache of states holds only the plain ones besides.
+    """
+    def __init__(self, size=1024):
+        self.size = size
+        # (fg, bg, bold, italic, underline): [group names]
+        self.cache = {}
+        # name: nvim_set_hl() attributes
+        self.pending = {}
+        self.defined = 0
+
+    def groups(self, fg, bg, bold, italic, underline):
+        key = (fg, bg, bold, italic, underline)
+        groups = self.cache.get(key)
+        if groups is None:
+            if self.defined >= self.size and not is_plain(*key):
+                # full: use the plain state, so the cache stays bounded too
+                key = (fg if fg in range(16) else None, None, bold, False, False)
+                groups = self.cache.get(key)
+            if groups is None:
+                groups = self.cache[key] = self.make_groups(*key)
+        return groups
+
+    def make_groups(self, fg, bg, bold, italic, underline):
+        if bold and isinstance(fg, int) and fg < 8:
+            fg += 8 # be bright and shiny
+        if is_plain(fg, bg, bold, italic, underline):
+            groups = []
+            if fg in range(16):
+                groups.append("IPyFg{}".format(fg))
+            if bold:
+                groups.append("IPyBold")
+            return groups
+
+        name = 'IPyC'
+        attrs = {}
+        if fg is not None:
+            name += '_f' + color_name(fg)
+            attrs['fg'], attrs['ctermfg'] = color_spec(fg)
+        if bg is not None:
+            name += '_b' + color_name(bg)
+            attrs['bg'], attrs['ctermbg'] = color_spec(bg)
+        flags = ''
+        for flag, attr, on in [('B', 'bold', bold), ('I', 'italic', italic),
+                               ('U', 'underline', underline)]:
+            if on:
+                flags += flag
+                attrs[attr] = True
+        if flags:
+            name += '_' + flags
+        self.pending[name] = attrs
+        self.defined += 1
+        return [name]
+
+    def take_pending(self):
+        """Definitions of the groups created since the last call, or None."""
+        if not self.pending:
+            return None
+        pending, self.pending = self.pending, {}
+        return pending
@@ -0,0 +1,254 @@
+"""Jupyter application and kernel management.
+
+Importing jupyter_client takes longer than the rest of the plugin, so this
+module is only imported when connecting to a kernel.
+"""
+from collections import deque
+import os
+import atexit
+import threading
+import time
+import logging
+from traceback import format_exc
+
+from jupyter_client import KernelManager
+from jupyter_client.kernelspec import NATIVE_KERNEL_NAME
+from jupyter_client.threaded import ThreadedKernelClient
+from jupyter_client.channels import HBChannel
+from jupyter_core.application import JupyterApp
+from jupyter_client.consoleapp import JupyterConsoleApp
+
+logger = logging.getLogger(__name__)
+warn = logger.warn
+
+class RedirectingKernelManager(KernelManager):
+    def _launch_kernel(self, cmd, **b):
+        # stdout is used to communicate with nvim, redirect it somewhere else
+        nullfile = "/dev/null" if os.name != 'nt' else 'NUL'
+        self._null = open(nullfile,"wb",0)
+        b['stdout'] = self._null.fileno()
+        b['stderr'] = self._null.fileno()
+        return super(RedirectingKernelManager, self)._launch_kernel(cmd, **b)
+
+class KernelPool(object):
+    """Kernels started ahead of time, so connecting doesn't wait for startup.
+
+    Up to size kernels of kernel_name are kept running, each of which has
+    executed the preload code. get() hands one out and starts a replacement
+    in a background thread.
+    """
+    def __init__(self):
+        self.size = 0
+        self.kernel_name = NATIVE_KERNEL_NAME
+        self.preload = ''
+        self.kernels = deque()
+        self.starting = 0
+        self.lock = threading.Lock()
+        atexit.register(self.shutdown)
+
+    def configure(self, size, kernel_name='', preload=''):
+        kernel_name = normalize_kernel_name(kernel_name)
+        with self.lock:
+            if kernel_name != self.kernel_name or preload != self.preload:
+                stale = list(self.kernels)
+                self.kernels.clear()
+            else:
+                stale = []
+            # the pool was made smaller
+            while len(self.kernels) > max(size, 0):
+                stale.append(self.kernels.pop())
+            self.size, self.kernel_name, self.preload = size, kernel_name, preload
+        for km in stale:
+            km.shutdown_kernel(now=True)
+        self.refill()
+
+    def get(self, kernel_name):
+        """A running kernel manager for kernel_name, or None."""
+        km = None
+        with self.lock:
+            if normalize_kernel_name(kernel_name) == self.kernel_name:
+                while self.kernels and km is None:
+                    km = self.kernels.popleft()
+                    if not km.is_alive():
+                        km = None
+        self.refill()
+        return km
+
+    def refill(self):
+        with self.lock:
+            missing = self.size - len(self.kernels) - self.starting
+            self.starting += max(missing, 0)
+            args = self.kernel_name, self.preload
+        for i in range(missing):
+            threading.Thread(target=self.start_one, args=args, daemon=True).start()
+
+    def start_one(self, kernel_name, preload):
+        try:
+            km = RedirectingKernelManager(kernel_name=kernel_name)
+            km.client_factory = ThreadedKernelClient
+            km.start_kernel()
+            if preload:
+                kc = km.blocking_client()
+                kc.start_channels()
+                try:
+                    kc.wait_for_ready(timeout=60)
+                    kc.execute_interactive(preload, silent=True, store_history=False,
+                                           timeout=600, output_hook=lambda msg: None)
+                finally:
+                    kc.stop_channels()
+        except Exception:
+            warn("Couldn't start pooled kernel: %s", format_exc())
+            with self.lock:
+                self.starting -= 1
+            return
+        with self.lock:
+            self.starting -= 1
+            current = (kernel_name, preload) == (self.kernel_name, self.preload)
+            keep = current and len(self.kernels) < self.size
+            if keep:
+                self.kernels.append(km)
+        if not keep:
+            km.shutdown_kernel(now=True)
+            if not current:
+                # it was counted as starting when the pool was refilled
+                # for the new configuration
+                self.refill()
+
+    def stats(self):
+        with self.lock:
+            return {'ready': len(self.kernels), 'starting': self.starting,
+                    'size': self.size, 'kernel': self.kernel_name}
+
+    def shutdown(self):
+        with self.lock:
+            self.size = 0
+            kernels = list(self.kernels)
+            self.kernels.clear()
+        for km in kernels:
+            try:
+                km.shutdown_kernel(now=True)
+            except Exception:
+                pass
+
+def normalize_kernel_name(name):
+    # the same aliases as KernelManager
+    return NATIVE_KERNEL_NAME if name in ('', 'python') else name
+
+# because Dependency Injection
+def fakefactory(factory, handler, stamp=False):
+    if not stamp:
+        class theclass(factory):
+            call_handlers = handler
+        return theclass
+    class theclass(factory):
+        def call_handlers(self, msg):
+            # time of arrival, for latency stats
+            msg['nvim_ipy_recv'] = time.time()
+            handler(msg)
+    return theclass
+
+class TimedHBChannel(HBChannel):
+    """Heartbeat channel which also measures the round trip of each beat.
+
+    Like HBChannel, a ping is sent every time_to_dead seconds, and
+    call_handlers(since_last_heartbeat) is called when no reply came in
+    time. on_beat(seconds) gets the round trip time of each reply.
+    """
+    # seconds between checks for stop() while waiting for a reply
+    poll_interval = 0.05
+
+    def on_beat(self, seconds):
+        pass
+
+    def run(self):
+        self._create_socket()
+        self._running = True
+        self._beating = True
+        while self._running:
+            if self._pause:
+                self._exit.wait(self.time_to_dead)
+                continue
+            self.socket.send(b'ping')
+            sent = time.time()
+            # wait in short slices, so that stop() doesn't wait for a beat
+            beating = False
+            while self._running and not beating:
+                left = sent + self.time_to_dead - time.time()
+                if left <= 0:
+                    break
+                beating = bool(self.poller.poll(1000 * min(left, self.poll_interval)))
+            self._beating = beating
+            if beating:
+                self.socket.recv()
+                self.on_beat(time.time() - sent)
+                self._exit.wait(max(sent + self.time_to_dead - time.time(), 0))
+            elif self._running:
+                self.call_handlers(time.time() - sent)
+                # the REQ/REP cycle is broken, start over
+                self._create_socket()
+
+def hbfactory(health, on_update):
+    """Heartbeat channel recording into health, which calls on_update()
+    when the state should be shown again."""
+    class theclass(TimedHBChannel):
+        def on_beat(self, seconds):
+            if health.beat(seconds):
+                on_update()
+
+        def call_handlers(self, since_last_heartbeat):
+            if health.failed():
+                on_update()
+    return theclass
+
+class JupyterVimApp(JupyterApp, JupyterConsoleApp):
+    # don't use blocking client; we override call_handlers below
+    kernel_client_class = ThreadedKernelClient
+    kernel_manager_class = RedirectingKernelManager
+    aliases = JupyterConsoleApp.aliases #this the way?
+    flags = JupyterConsoleApp.flags
+    kernel_pool = None
+    health = None
+
+    def init_kernel_manager(self):
+        km = None
+        if self.kernel_pool is not None and not (self.existing or self.kernel_argv or
+                                                 self.sshserver):
+            km = self.kernel_pool.get(self.kernel_name)
+        if km is None:
+            return super(JupyterVimApp, self).init_kernel_manager()
+        self.kernel_manager = km
+        self.shell_port = km.shell_port
+        self.iopub_port = km.iopub_port
+        self.stdin_port = km.stdin_port
+        self.hb_port = km.hb_port
+        self.control_port = km.control_port
+        self.connection_file = km.connection_file
+        atexit.register(km.cleanup_ipc_files)
+        atexit.register(km.cleanup_connection_file)
+
+    def init_kernel_client(self):
+        #TODO: cleanup this (by subclassing kernel_clinet or something)
+        if self.kernel_manager is not None:
+            self.kernel_client = self.kernel_manager.client()
+        else:
+            self.kernel_client = self.kernel_client_class(
+                                session=self.session,
+                                ip=self.ip,
+                                transport=self.transport,
+                                shell_port=self.shell_port,
+                                iopub_port=self.iopub_port,
+                                stdin_port=self.stdin_port,
+                                hb_port=self.hb_port,
+                                connection_file=self.connection_file,
+                                parent=self,
+            )
+        self.kernel_client.shell_channel_class = fakefactory(self.kernel_client.shell_channel_class, self.target.on_shell_msg, True)
+        self.kernel_client.iopub_channel_class = fakefactory(self.kernel_client.iopub_channel_class, self.target.on_iopub_msg, True)
+        self.kernel_client.stdin_channel_class = fakefactory(self.kernel_client.stdin_channel_class, self.target.on_stdin_msg, True)
+        self.kernel_client.hb_channel_class = hbfactory(self.health, self.target.on_health)
+        self.kernel_client.start_channels()
+
+    def initialize(self, target, argv):
+        self.target = target
+        super(JupyterVimApp, self).initialize(argv)
+        JupyterConsoleApp.initialize(self, argv)
@@ -0,0 +1,177 @@
+"""Store of rich outputs (MIME bundles), with spill of large payloads to disk."""
+import base64
+import json
+import mmap
+import os
+import shutil
+import tempfile
+from collections import OrderedDict
+
+# file extensions used when exporting a MIME type
+EXTENSIONS = {
+    'image/png': '.png',
+    'image/jpeg': '.jpg',
+    'image/gif': '.gif',
+    'image/svg+xml': '.svg',
+    'application/pdf': '.pdf',
+    'text/html': '.html',
+    'text/markdown': '.md',
+    'text/latex': '.tex',
+    'text/plain': '.txt',
+    'application/javascript': '.js',
+}
+
+def is_binary(mime):
+    """Binary payloads are base64 encoded in the messages."""
+    return (mime.startswith(('image/', 'audio/', 'video/')) and mime != 'image/svg+xml'
+            or mime == 'application/pdf')
+
+def encode(mime, data):
+    if is_binary(mime):
+        return base64.b64decode(data)
+    if not isinstance(data, str):
+        # json MIME types are sent as nested data
+        data = json.dumps(data, indent=1)
+    return data.encode('utf-8')
+
+class Spilled(object):
+    """A payload which lives in a file of the store's directory."""
+    def __init__(self, path, size):
+        self.path = path
+        self.size = size
+
+    def read(self):
+        with open(self.path, 'rb') as f:
+            if self.size == 0:
+                return b''
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                return m[:]
+
+class OutputStore(object):
+    """Every MIME bundle shown by the kernel, keyed by (execution_count, msg_id).
+
+    Payloads are kept as bytes, binary ones base64 decoded. Payloads of at
+    least spill_size bytes go straight to a temporary directory, and when the
+    payloads in memory exceed memory_budget bytes, the least recently used
+    ones are spilled as well. When the files exceed disk_budget, whole
+    outputs are forgotten, oldest first. close() removes the directory.
+    """
+    def __init__(self, memory_budget=32<<20, spill_size=256<<10, disk_budget=1<<30):
+        self.memory_budget = memory_budget
+        self.spill_size = spill_size
+        self.disk_budget = disk_budget
+        # key: {mime: bytes or Spilled}, oldest first
+        self.outputs = OrderedDict()
+        # (key, mime) of payloads in memory, least recently used first
+        self.lru = OrderedDict()
+        self.memory = 0
+        self.disk = 0
+        self.dir = None
+        self.nfiles = 0
+
+    def __len__(self):
+        return len(self.outputs)
+
+    def add(self, execution_count, msg_id, data):
+        key = (execution_count, msg_id)
+        self.remove(key)
+        bundle = self.outputs[key] = {}
+        for mime, value in data.items():
+            payload = encode(mime, value)
+            if len(payload) >= self.spill_size:
+                bundle[mime] = self.spill(payload)
+            else:
+                bundle[mime] = payload
+                self.lru[(key, mime)] = None
+                self.memory += len(payload)
+        self.enforce()
+        return key
+
+    def remove(self, key):
+        bundle = self.outputs.pop(key, None)
+        if bundle is None:
+            return
+        for mime, payload in bundle.items():
+            if isinstance(payload, Spilled):
+                self.disk -= payload.size
+                try:
+                    os.remove(payload.path)
+                except OSError:
+                    pass
+            else:
+                self.memory -= len(payload)
+                del self.lru[(key, mime)]
+
+    def spill(self, payload):
+        if self.dir is None:
+            self.dir = tempfile.mkdtemp(prefix='nvim-ipy-outputs-')
+        self.nfiles += 1
+        path = os.path.join(self.dir, str(self.nfiles))
+        with open(path, 'wb') as f:
+            f.write(payload)
+        self.disk += len(payload)
+        return Spilled(path, len(payload))
+
+    def enforce(self):
+        while self.memory > self.memory_budget and self.lru:
+            (key, mime), _ = self.lru.popitem(last=False)
+            payload = self.outputs[key][mime]
+            self.memory -= len(payload)
+            self.outputs[key][mime] = self.spill(payload)
+        while self.disk > self.disk_budget and len(self.outputs) > 1:
+            self.remove(next(iter(self.outputs)))
+
+    def find(self, execution_count=None, index=-1):
+        """Keys of the outputs of execution_count (default the latest
+        execution with output), and the key at index among them."""
+        if not self.outputs:
+            return [], None
+        if execution_count is None:
+            execution_count = next(reversed(self.outputs))[0]
+        keys = [k for k in self.outputs if k[0] == execution_count]
+        try:
+            return keys, keys[index]
+        except IndexError:
+            return keys, None
+
+    def mimetypes(self, key):
+        return list(self.outputs.get(key, ()))
+
+    def get(self, key, mime):
+        """The payload as bytes, or None."""
+        payload = self.outputs.get(key, {}).get(mime)
+        if payload is None:
+            return None
+        if isinstance(payload, Spilled):
+            return payload.read()
+        self.lru.move_to_end((key, mime))
+        return payload
+
+    def export(self, key, mime, path):
+        """Write the payload to path, without loading spilled payloads."""
+        payload = self.outputs[key][mime]
+        if isinstance(payload, Spilled):
+            shutil.copyfile(payload.path, path)
+        else:
+            with open(path, 'wb') as f:
+                f.write(payload)
+        return path
+
+    def export_temp(self, key, mime):
+        """Write the payload to a new file in the store's directory, named
+        with the extension of mime."""
+        if self.dir is None:
+            self.dir = tempfile.mkdtemp(prefix='nvim-ipy-outputs-')
+        name = 'out{}-{}{}'.format(key[0], key[1][:8], EXTENSIONS.get(mime, ''))
+        return self.export(key, mime, os.path.join(self.dir, name))
+
+    def stats(self):
+        return {'outputs': len(self.outputs), 'memory': self.memory, 'disk': self.disk}
+
+    def close(self):
+        self.outputs.clear()
+        self.lru.clear()
+        self.memory = self.disk = 0
+        if self.dir is not None:
+            shutil.rmtree(self.dir, ignore_errors=True)
+            self.dir = None
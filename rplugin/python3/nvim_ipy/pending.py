@@ -0,0 +1,56 @@
+"""Tracking of shell requests waiting for a reply."""
+import time
+
+# timeout for requests which may legitimately take forever, like execute
+FOREVER = float('inf')
+
+class RequestTimeout(Exception):
+    """Raised in a greenlet whose shell reply didn't arrive in time."""
+
+class PendingRequests(object):
+    """Handlers for shell replies by msg_id, each with a deadline.
+
+    A handler is a greenlet to resume with the reply, a callable, or None to
+    ignore the reply. Entries whose deadline has passed are removed by
+    expire(), which the plugin calls periodically.
+    """
+    def __init__(self, default_timeout=30):
+        self.default_timeout = default_timeout
+        # msg_id: (handler, deadline, time sent)
+        self.entries = {}
+        self.timed_out = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, msg_id, handler, timeout=None):
+        if timeout is None:
+            timeout = self.default_timeout
+        now = time.time()
+        self.entries[msg_id] = (handler, now + timeout, now)
+
+    def pop(self, msg_id):
+        """Remove and return (handler, time sent) for msg_id.
+
+        Raises KeyError for unknown (or expired) requests.
+        """
+        handler, deadline, sent = self.entries.pop(msg_id)
+        return handler, sent
+
+    def expire(self, now=None):
+        """Remove and return [(msg_id, handler)] whose deadline has passed."""
+        if now is None:
+            now = time.time()
+        expired = [(msg_id, e[0]) for msg_id, e in self.entries.items() if e[1] <= now]
+        for msg_id, handler in expired:
+            del self.entries[msg_id]
+        self.timed_out += len(expired)
+        return expired
+
+    def next_deadline(self):
+        """Earliest finite deadline, or None."""
+        deadlines = [e[1] for e in self.entries.values() if e[1] != FOREVER]
+        return min(deadlines) if deadlines else None
+
+    def stats(self):
+        return {'outstanding': len(self.entries), 'timed_out': self.timed_out}
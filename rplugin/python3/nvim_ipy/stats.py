@@ -0,0 +1,64 @@
+"""Latency statistics of the message and render paths."""
+from collections import deque
+import json
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+class Histogram(object):
+    """The last `size` samples of a duration, in seconds."""
+    def __init__(self, size=1000):
+        self.samples = deque(maxlen=size)
+        self.count = 0
+
+    def add(self, value):
+        self.samples.append(value)
+        self.count += 1
+
+    def summary(self):
+        """Percentiles over the kept samples, in milliseconds."""
+        s = sorted(self.samples)
+        if not s:
+            return {'count': self.count}
+        def pct(p):
+            return 1000 * s[min(int(p * len(s)), len(s) - 1)]
+        return {
+            'count': self.count,
+            'mean': 1000 * sum(s) / len(s),
+            'p50': pct(0.5),
+            'p90': pct(0.9),
+            'p99': pct(0.99),
+            'max': 1000 * s[-1],
+        }
+
+class Stats(object):
+    """Named latency histograms.
+
+    If `log` is set, every sample is also written to the debug log as a
+    line of JSON, prefixed by "stats ".
+    """
+    def __init__(self, size=1000):
+        self.size = size
+        self.hists = {}
+        self.log = False
+
+    def record(self, name, seconds):
+        hist = self.hists.get(name)
+        if hist is None:
+            hist = self.hists[name] = Histogram(self.size)
+        hist.add(seconds)
+        if self.log:
+            logger.debug('stats %s', json.dumps({'name': name, 'ms': 1000 * seconds,
+                                                 'time': time.time()}))
+
+    def since(self, name, start):
+        """Record the time passed since `start`, if it is known."""
+        if start is not None:
+            self.record(name, time.time() - start)
+
+    def summary(self):
+        return {name: hist.summary() for name, hist in self.hists.items()}
+
+    def clear(self):
+        self.hists.clear()